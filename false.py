@@ -1,9 +1,9 @@
 #!/usr/bin/python3
 
-import false.publish, false.publish_media, false.build, false.config
+import false.publish, false.publish_media, false.build, false.config, false.graph, false.profiler, false.snapshot, false.watch, false.imaging, false.mdcache
 import rdflib
 from rdflib.namespace import RDF, DC, SKOS, OWL
-import sys, logging, os, re, urllib.parse, datetime
+import sys, logging, os, re, urllib.parse, datetime, time
 import jinja2, markdown
 import pprint
 
@@ -15,6 +15,78 @@ except KeyError:
     pass
 logging.basicConfig(level=logging.DEBUG,handlers=log_handlers)
 
+def builder_options():
+    '''Return the options the builder is run with. They are part of the snapshot digest too,
+    so that changing any of them builds again rather than reusing a snapshot.'''
+    return dict(jobs=int(os.environ.get("FALSE_JOBS",0)),
+                ipfs_add=bool(os.environ.get("FALSE_IPFS_ADD")),
+                image_backend=os.environ.get("FALSE_IMAGE_BACKEND","convert"))
+
+def build_graph(cfg, src_root, false_ttl):
+    '''Build the graph from the sources and copy its media into the publish area.
+    Returns the media, and the graph without their local paths.'''
+    b = false.build.Builder(cfg.work_dir, cfg.id_base, **builder_options())
+    for fn in false_ttl:
+        b.add_ttl(fn)
+    b.add_dir(src_root)
+    g = b.build()
+
+    g.serialize(destination=os.path.join(cfg.work_dir,"__result.ttl"), format="ttl")
+
+    logging.info("** Publishing media **")
+
+    # Copy media files into the publish area (via IPFS or directly)
+    # and remove local paths
+    media = false.publish_media.publish_media(g, cfg.output_dir)
+    return media, g
+
+def watch(cfg, src_root, false_ttl, tg, publisher):
+    '''Publish again whenever anything changes under src_root or the template dir, until interrupted.
+    The graph is built again from scratch, which is quick as the builder's caches are warm,
+    but only its differences are applied to tg, and only the pages they might affect are rendered again.'''
+    template_dir = os.path.abspath(cfg.template_dir)
+    watcher = false.watch.Watcher(os.path.abspath(src_root), template_dir)
+    changed = set() # safe names of changed entities not yet published
+    templates = set() # names of changed templates not yet published
+
+    logging.info(f"** Watching {src_root} and {cfg.template_dir} for changes **")
+    while True:
+        paths = watcher.wait()
+        started = time.time()
+        logging.info(f"** {len(paths)} files changed, publishing again **")
+
+        try:
+            templates.update(os.path.relpath(f, template_dir) for f in paths if f.startswith(template_dir+os.sep))
+            if any(not f.startswith(template_dir+os.sep) for f in paths):
+                media, g = build_graph(cfg, src_root, false_ttl)
+                false.publish.fix_ipfs_uris(g)
+
+                if set(g.namespaces()) != set(tg.g.namespaces()):
+                    # every entity's safe name might be different
+                    logging.info("Namespaces have changed, publishing everything")
+                    old_dests = set(dest for tpl, dest in publisher.stage.values())
+                    tg = false.graph.TemplatableGraph(g)
+                    publisher = false.publish.Publisher(tg, cfg, watch=True, jobs=int(os.environ.get("FALSE_JOBS",0)))
+                    publisher.publish()
+                    for dest in old_dests - set(dest for tpl, dest in publisher.stage.values()):
+                        os.remove(dest)
+                    changed = set()
+                else:
+                    old = set(tg.g)
+                    new = set(g)
+                    changed.update(e.safe for e in tg.apply_delta(added=new - old, removed=old - new))
+                    tg.g = g
+
+            n = publisher.update(changed, templates)
+            changed = set()
+            templates = set()
+
+            tg.g.serialize(destination=os.path.join(cfg.page_output_dir,"site.ttl"),format="ttl")
+            logging.info(f"** Published {n} pages in {time.time()-started:.2f}s **")
+        except Exception:
+            # keep what is left to publish for next time, the fix is probably on its way
+            logging.exception("Couldn't publish")
+
 if __name__=="__main__":
 
     logging.info(f"*** Started FALSE at {datetime.datetime.now().isoformat()} ***")
@@ -29,25 +101,59 @@ if __name__=="__main__":
                           page_output_path=os.environ.get("FALSE_PAGE_OUT_PATH",None),
                           page_file_type=os.environ.get("FALSE_PAGE_FILE_TYPE","html"))
 
-    b = false.build.Builder(cfg.work_dir, cfg.id_base)
-    b.add_ttl(os.path.join(os.path.dirname(false.build.__file__),"false.ttl"))
-    b.add_ttl(os.path.join(os.path.dirname(false.build.__file__),"false-xl.ttl"))
-    b.add_dir(os.environ["FALSE_SRC"])
-    g = b.build()
+    false_ttl = [os.path.join(os.path.dirname(false.build.__file__),"false.ttl"),
+                 os.path.join(os.path.dirname(false.build.__file__),"false-xl.ttl")]
 
-    g.serialize(destination=os.path.join(os.environ["FALSE_WORK_DIR"],"__result.ttl"), format="ttl")
+    # If nothing has changed since the last run, skip building and reuse its graph
+    src_files = [os.path.join(path, f) for path, f in false.build.source_files(os.environ["FALSE_SRC"], cfg.work_dir)]
+    options = builder_options()
+    if options['image_backend'] == 'pil':
+        options['imaging'] = false.imaging.version()
+    digest = false.snapshot.digest(false_ttl+[f for f in src_files if f.endswith('.ttl')],
+                                   [f for f in src_files if not f.endswith('.ttl')],
+                                   cfg.id_base, options)
+    if os.environ.get("FALSE_NO_SNAPSHOT"):
+        snapshot = None
+    else:
+        snapshot = false.snapshot.load(cfg.work_dir, digest)
 
-    logging.info("** Publishing media **")
+    if snapshot:
+        media, tg = snapshot
 
-    # Copy media files into the publish area (via IPFS or directly)
-    # and remove local paths
-    false.publish_media.publish_media(g, cfg.output_dir)
+        logging.info("** Publishing media **")
+        false.publish_media.copy_media(media, cfg.output_dir)
+    else:
+        built = false.mdcache.mark(cfg.work_dir)
+        media, g = build_graph(cfg, os.environ["FALSE_SRC"], false_ttl)
+        tg = false.publish.prepare_graph(g)
+        false.snapshot.save(cfg.work_dir, digest, media, tg)
+
+    g = tg.g
 
     logging.info("** Publishing graph **")
 
+    if os.environ.get("FALSE_PROFILE"):
+        # count template attribute lookups, and report the hottest and most missed
+        profiler = false.profiler.AttributeProfiler()
+        false.graph.set_profiler(profiler)
+    else:
+        profiler = None
+
     # Build HTML pages
-    home_page = false.publish.publish_graph(g, cfg)
+    # When watching, the publisher remembers what each page depends on, so that it can publish only what changes
+    publisher = false.publish.Publisher(tg, cfg, watch=bool(os.environ.get("FALSE_WATCH")), jobs=int(os.environ.get("FALSE_JOBS",0)))
+    home_page = publisher.publish()
+
+    if not snapshot:
+        # the builder and the publisher have used all the markdown they need from the cache, so forget the rest
+        false.mdcache.prune(cfg.work_dir, built)
+
+    if profiler:
+        logging.info(profiler.report())
 
     g.serialize(destination=os.path.join(cfg.page_output_dir,"site.ttl"),format="ttl")
 
-    print(home_page)
+    print(home_page, flush=True)
+
+    if os.environ.get("FALSE_WATCH"):
+        watch(cfg, os.environ["FALSE_SRC"], false_ttl, tg, publisher)
@@ -2,9 +2,15 @@
 
 import rdflib
 from rdflib.namespace import RDF, RDFS, DC, SKOS, OWL, XSD
-import logging, os, re, io, datetime, markdown, urllib.parse, json, posixpath, time, subprocess
+import logging, os, re, io, datetime, urllib.parse, json, posixpath, time, subprocess, concurrent.futures, hashlib, pickle, gc
 from zlib import adler32
 
+from false.manifest import Manifest, content_hash
+from false.unixfs import hash_dirs
+from false.mdcache import MarkdownCache
+from false.markdown import parse_markdown
+import false.imaging as imaging
+
 F = rdflib.Namespace("http://id.colourcountry.net/false/")
 
 # rdflib will happily save relative-looking URIs, but it puts "file:///" in front when loading them :(
@@ -62,6 +68,16 @@ convert_image = {
     F.download: copy,
 }
 
+# what the image commands make, for the in-process image backend (false.imaging), so these must agree with them
+IMAGE_GEOMETRY = {
+    F.teaser: (imaging.FILL, 400, 225),
+    F.embed: (imaging.SHRINK, 800, 800),
+    F.page: (imaging.SHRINK, 1200, 1200),
+}
+
+# "convert" runs the commands in convert_image, "pil" makes all the sizes of an image in-process from one decode
+IMAGE_BACKENDS = ("convert", "pil")
+
 # embeddable files can't be processed into teasers and are not separately downloadable
 convert_embeddable = { F.embed: copy, F.page: copy  }
 
@@ -78,91 +94,271 @@ CONVERSIONS = {
 }
 
 def ipfs_add_dir(dirpath):
-    r = subprocess.run(["ipfs","add","-Qnr",dirpath], stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout.strip()
-    # Remove the "n" to actually add to IPFS. With "n", hashes and copies only.
-    # FIXME: make accessible to user
+    '''Add a directory to IPFS with the ipfs command, which must be installed.
+    Only used if the Builder is asked to add to IPFS, otherwise false.unixfs computes the same hashes in-process,
+    and only asks `ipfs add -Qnr` about renditions with files too big for it to be sure of.'''
+    r = subprocess.run(["ipfs","add","-Qr",dirpath], stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout.strip()
     logging.info(f"{r} added from {dirpath}")
     return r
 
-def get_existing_hash(blob, entity_dir, blob_path):
-    # FIXME: this will only catch changes to the blob, not to the info (is this bad?)
-
-    id_cache_file = entity_dir+".ipfs-hash"
-    try:
-        existing_hash = open(id_cache_file,"rb").read()
-    except FileNotFoundError:
-        logging.info(f"{entity_dir}: no existing hash available")
-        return
-
-    try:
-        existing_size = os.path.getsize(blob_path)
-    except OSError:
-        existing_size = 0
-
-    if len(blob) != existing_size:
-        logging.info(f"{entity_dir}: blob has changed size")
-        return
-
-    old_blob = open(blob_path,"rb").read()
-
-    if old_blob != blob:
-        logging.info(f"{entity_dir}: blob has changed")
-        return
-
-    return existing_hash
-
+def nt_row(triple):
+    '''Return triple as a line of N-Triples, written the same way as rdflib's N-Triples serializer writes it.'''
+    s, p, o = triple
+    if isinstance(o, rdflib.Literal):
+        quoted = '"%s"' % o.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"').replace("\r", "\\r")
+        if o.language:
+            o = f"{quoted}@{o.language}"
+        elif o.datatype:
+            o = f"{quoted}^^<{o.datatype}>"
+        else:
+            o = quoted
+    else:
+        o = o.n3()
+    return f"{s.n3()} {p.n3()} {o} .\n"
 
 # h/t https://stackoverflow.com/questions/29259912/how-can-i-get-a-list-of-image-urls-from-a-markdown-file-in-python
-class ImgExtractor(markdown.treeprocessors.Treeprocessor):
-    def __init__(self, md, base):
-        self.base = base
-        super(ImgExtractor, self).__init__(md)
-
-    def run(self, doc):
-        "Find all images and links and create lists of them. "
-        self.markdown.images = []
-        self.markdown.links = []
-
-        # <false-content> tags are embeds if their contexts is the special embed context
-        # otherwise we assume they are links
-        for el in doc.findall('.//false-content'):
-            if rdflib.URIRef(el.get('context')) == F.embed:
-                self.markdown.images.append(urllib.parse.urljoin(self.base, el.get('src')))
-            else:
-                self.markdown.links.append(urllib.parse.urljoin(self.base, el.get('src')))
-
-        # All of these will get transformed into <false-content> in the publish stage
-        for el in doc.findall('.//img'):
-            self.markdown.images.append(urllib.parse.urljoin(self.base, el.get('src')))
-        for el in doc.findall('.//false-embed'):
-            self.markdown.images.append(urllib.parse.urljoin(self.base, el.get('src')))
-        for el in doc.findall('.//false-teaser'):
-            self.markdown.links.append(urllib.parse.urljoin(self.base, el.get('src')))
-
-        # Regular links (which are safe because they don't use any data from the linked item)
-        for el in doc.findall('.//a'):
-            self.markdown.links.append(urllib.parse.urljoin(self.base, el.get('href')))
-
-
-class ImgExtExtension(markdown.extensions.Extension):
-    def __init__(self, **kwargs):
-        self.config = {'base' : ['http://example.org/', 'The base URI to use when embedded content is specified as a relative URL']}
-        super(ImgExtExtension, self).__init__(**kwargs)
-
-    def extendMarkdown(self, md, md_globals):
-        img_ext = ImgExtractor(md, self.getConfig('base'))
-        md.treeprocessors.add('imgext', img_ext, '>inline')
-
+def find_images_and_links(doc, base):
+    "Find all images and links in the markdown tree doc and return lists of them. "
+    images = []
+    links = []
+
+    # <false-content> tags are embeds if their contexts is the special embed context
+    # otherwise we assume they are links
+    for el in doc.findall('.//false-content'):
+        if rdflib.URIRef(el.get('context')) == F.embed:
+            images.append(urllib.parse.urljoin(base, el.get('src')))
+        else:
+            links.append(urllib.parse.urljoin(base, el.get('src')))
+
+    # All of these will get transformed into <false-content> in the publish stage
+    for el in doc.findall('.//img'):
+        images.append(urllib.parse.urljoin(base, el.get('src')))
+    for el in doc.findall('.//false-embed'):
+        images.append(urllib.parse.urljoin(base, el.get('src')))
+    for el in doc.findall('.//false-teaser'):
+        links.append(urllib.parse.urljoin(base, el.get('src')))
+
+    # Regular links (which are safe because they don't use any data from the linked item)
+    for el in doc.findall('.//a'):
+        links.append(urllib.parse.urljoin(base, el.get('href')))
+
+    return images, links
+
+# Parsed TTL files are cached in this directory under the work dir
+TTL_CACHE_DIR = "__ttl"
+
+# Bump this whenever the contents of the TTL cache change
+TTL_CACHE_VERSION = 2
+
+# TTL files bigger than this are split into pieces of about this size, which are parsed in parallel
+TTL_SPLIT_SIZE = 4*1024*1024
+
+# The parts of Turtle that matter when looking for the end of a statement
+TTL_TOKENS = re.compile('|'.join([
+    r'"""(?:"{0,2}(?:[^"\\]|\\.))*"""', # long strings
+    r"'''(?:'{0,2}(?:[^'\\]|\\.))*'''",
+    r'"(?:[^"\\\n\r]|\\.)*"', # strings
+    r"'(?:[^'\\\n\r]|\\.)*'",
+    r'<[^>\s]*>', # IRIs
+    r'#[^\n]*', # comments
+    r'_:', # blank node labels
+    r'(?<![@:\w])(?:PREFIX|BASE)\b', # SPARQL-style directives
+    r'[\[\]()]',
+    r'\.(?=\s)', # end of statement, unless nested
+]), re.IGNORECASE)
+
+TTL_DIRECTIVE = re.compile(r'(?:\s|#[^\n]*)*@(?:prefix|base)\b')
+
+class RecordingGraph(rdflib.Graph):
+    '''Remembers the namespaces that parsing binds, so that they can be bound in the same order on another graph.'''
+    def __init__(self):
+        rdflib.Graph.__init__(self)
+        self.bindings = []
+
+    def bind(self, prefix, namespace, *args, **kwargs):
+        self.bindings.append((prefix, namespace))
+        return rdflib.Graph.bind(self, prefix, namespace, *args, **kwargs)
+
+def parse_ttl(source, id_base, data=False):
+    '''Parse TTL from a file, or from a string if data is true. Runs in a worker process.
+    Returns the namespaces that parsing bound, the triples, and the entities that they make private.'''
+    g = RecordingGraph()
+    if data:
+        g.parse(data=source, format='ttl', publicID=id_base)
+    else:
+        g.parse(source, format='ttl', publicID=id_base)
+    return g.bindings, list(g), list(g.subjects(F.hasAvailability, F.private))
+
+def split_ttl(text, size=TTL_SPLIT_SIZE):
+    '''Split Turtle into pieces of about size characters that can be parsed separately, or return None if it can't be.
+    Pieces end at the end of a top-level statement, and start with the @prefix and @base directives that came before.
+    Blank node labels are document-wide, and SPARQL-style directives have no terminating dot, so either prevents splitting.'''
+    pieces = []
+    directives = []
+    depth = 0
+    start = 0 # of the current statement
+    piece_start = 0
+    for m in TTL_TOKENS.finditer(text):
+        t = m.group()
+        if t in '[(':
+            depth += 1
+        elif t in '])':
+            depth -= 1
+        elif t == '_:' or t.upper() in ('PREFIX', 'BASE'):
+            return None
+        elif t == '.' and depth == 0:
+            statement = text[start:m.end()]
+            if TTL_DIRECTIVE.match(statement):
+                directives.append((start, statement))
+            start = m.end()
+            if start - piece_start >= size:
+                pieces.append((len(pieces) > 0, piece_start, start))
+                piece_start = start
+
+    if not pieces:
+        return None
+
+    pieces.append((True, piece_start, len(text)))
+
+    # each piece after the first needs the directives from before it
+    r = []
+    for needs_header, a, b in pieces:
+        if needs_header:
+            header = ''.join(d for at, d in directives if at < a)
+            r.append(header + '\n' + text[a:b])
+        else:
+            r.append(text[a:b])
+    return r
 
+def image_geometry(ext, ctx, image_backend):
+    '''The geometry to convert ext files for ctx to in-process, or None if they are converted by a command.'''
+    if image_backend == "pil" and CONVERSIONS[ext] is convert_image:
+        return IMAGE_GEOMETRY.get(ctx)
+
+def conversion_command(ext, ctx, image_backend="convert"):
+    '''The command that converts ext files for ctx, as recorded in the manifest.'''
+    geometry = image_geometry(ext, ctx, image_backend)
+    if geometry:
+        return ["false.imaging", imaging.IMAGING_VERSION, *geometry]
+    return CONVERSIONS[ext][ctx]("{src}","{dest}")
+
+# The index of source directories is kept in this file under the work dir
+SOURCE_INDEX_FILE = "__sources.pickle"
+
+# Bump this whenever the contents of the source index change
+SOURCE_INDEX_VERSION = 1
+
+MEDIA_FILE = re.compile("(.*)[.]([^.]*)$")
+CONTEXT_FILES = [(re.compile("(.*)"+re.escape(pfx)+"[.]([^.]*)$"), ctx) for pfx, ctx in CONTEXTS.items()]
+
+def path_to_id(path, url=''):
+    if not path:
+        return url
+    p, s = os.path.split(path)
+    if not s:
+        return urllib.parse.quote(url)
+    if url:
+        return path_to_id(p, os.path.join(s, url))
+    return path_to_id(p, s)
+
+class SourceIndex:
+    '''The directories and files under source trees, kept in the work dir along with each directory's mtime,
+    so that a directory is only listed again once something has been added to, removed from or renamed in it.
+    Each directory also has a dict for remembering what has been worked out from its listing, which is emptied when it changes.
+    Without a work_dir, nothing is kept.'''
+
+    def __init__(self, work_dir=None):
+        self.old = {}
+        self.new = {}
+        self.changed = False # set this after adding to a directory's remembered dict
+        self.path = work_dir and os.path.join(work_dir, SOURCE_INDEX_FILE)
+        if not self.path:
+            return
 
+        try:
+            gc.disable()
+            try:
+                version, dirs = pickle.load(open(self.path, "rb"))
+            finally:
+                gc.enable()
+            if version == SOURCE_INDEX_VERSION:
+                self.old = dirs
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning(f"Ignoring source index {self.path}: {e}")
+
+    def scan(self, src_root):
+        '''Yield (directory, filenames, remembered) for src_root and every directory under it, top down,
+        leaving out directories that start with . or _.'''
+        stack = [src_root]
+        while stack:
+            path = stack.pop()
+            try:
+                mtime = os.stat(path).st_mtime_ns
+                e = self.old.get(path)
+                if e is None or e[0] != mtime:
+                    logging.debug(f"Looking in {path}")
+                    dirs = []
+                    files = []
+                    with os.scandir(path) as it:
+                        for entry in it:
+                            if entry.is_dir():
+                                if not entry.name.startswith('.') and not entry.name.startswith('_'):
+                                    dirs.append(entry.name)
+                            else:
+                                files.append(entry.name)
+                    e = (mtime, dirs, files, {})
+                    self.changed = True
+            except OSError as err:
+                logging.debug(f"Can't look in {path}: {err}")
+                continue
+
+            self.new[path] = e
+            yield path, e[2], e[3]
+            stack.extend(os.path.join(path, d) for d in reversed(e[1]))
+
+    def save(self):
+        '''Keep what was scanned, and forget anything that wasn't.'''
+        if not self.path or not (self.changed or self.new.keys() != self.old.keys()):
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path+".tmp", "wb") as f:
+            pickle.dump((SOURCE_INDEX_VERSION, self.new), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(self.path+".tmp", self.path)
+
+def source_files(src_root, work_dir=None):
+    '''Return (directory, filename) for every file that Builder.add_dir looks at.
+    With a work_dir, directories that haven't changed since they were last scanned aren't listed again.'''
+    index = SourceIndex(work_dir)
+    r = [(path, f) for path, files, remembered in index.scan(src_root) for f in files]
+    index.save()
+    return r
 
 class Builder:
-    def __init__(self, work_dir, id_base):
+    def __init__(self, work_dir, id_base, jobs=None, ipfs_add=False, image_backend="convert"):
         self.g = rdflib.Graph()
         self.work_dir = work_dir
         os.makedirs(work_dir, exist_ok=True)
         self.id_base = id_base
 
+        # how many conversions, hashes and parses to run at once
+        self.jobs = jobs or os.cpu_count() or 1
+
+        # whether to add renditions to IPFS for real, or only work out their hashes
+        self.ipfs_add = ipfs_add
+
+        if image_backend not in IMAGE_BACKENDS:
+            raise ValueError(f"Unknown image backend {image_backend}, expected one of {', '.join(IMAGE_BACKENDS)}")
+        if image_backend == "pil" and not imaging.available():
+            raise ValueError("The pil image backend needs Pillow, which is not installed")
+        self.image_backend = image_backend
+
+        self.manifest = Manifest(work_dir)
+
+        # shared with the publisher, which starts from the same parse
+        self.markdown_cache = MarkdownCache(work_dir)
+
         # Content can appear in these contexts.
         self.contexts_for_ava = {
                     F.public: {F.link, F.teaser, F.embed, F.page, F.download},
@@ -172,83 +368,189 @@ class Builder:
 
         self.files = {ctx: {} for ctx in set(CONTEXTS.values())}
 
-    def add_ttl(self, filename):
-        self.g.load(filename, format='ttl', publicID=self.id_base)
-        logging.info(f"loading rdf from {filename}")
-        return self
+        # private entities are dropped as they are loaded, we don't want to know about them, convert them, or add them to IPFS
+        self.private_ids = set()
 
-    def add_dir(self,src_root):
-        def path_to_id(path, url=''):
-            if not path:
-                return url
-            p, s = os.path.split(path)
-            if not s:
-                return urllib.parse.quote(url)
-            if url:
-                return path_to_id(p, os.path.join(s, url))
-            return path_to_id(p, s)
+    def add_ttl(self, filename):
+        return self.add_ttls([filename])
+
+    def add_ttls(self, filenames):
+        '''Load TTL files into the graph, with the same result as loading them one by one.
+        Files that haven't changed since they were last parsed come from the cache, the rest are parsed in parallel.'''
+        results = [None] * len(filenames)
+        stats = [os.stat(fn) for fn in filenames] # before parsing, so that a file changed meanwhile isn't cached as unchanged
+        jobs = [] # (file index, TTL file or data, whether it is data) for everything that needs parsing
+
+        for i, fn in enumerate(filenames):
+            results[i] = self._get_cached_ttl(fn, stats[i])
+            if results[i] is not None:
+                logging.debug(f"{fn}: unchanged since it was last parsed")
+                continue
+
+            pieces = None
+            if stats[i].st_size > TTL_SPLIT_SIZE:
+                pieces = split_ttl(open(fn, encoding='utf-8').read())
+            if pieces:
+                logging.info(f"{fn}: parsing in {len(pieces)} pieces")
+                jobs += [(i, piece, True) for piece in pieces]
+            else:
+                jobs.append((i, fn, False))
+
+        sources = [source for i, source, data in jobs]
+        data = [data for i, source, data in jobs]
+        if len(jobs) > 1 and self.jobs > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=min(self.jobs, len(jobs))) as pool:
+                parsed = list(pool.map(parse_ttl, sources, [self.id_base]*len(jobs), data))
+        else:
+            parsed = list(map(parse_ttl, sources, [self.id_base]*len(jobs), data))
+
+        for (i, source, is_data), (bindings, triples, private) in zip(jobs, parsed):
+            if results[i] is None:
+                results[i] = ([], [], [])
+            results[i][0].extend(bindings)
+            results[i][1].extend(triples)
+            results[i][2].extend(private)
+
+        # an entity can be made private by any file, so find them all before loading anything
+        private = set()
+        for bindings, triples, file_private in results:
+            private.update(file_private)
+        self._drop_private(private - self.private_ids)
+
+        # the graph only grows here, so there's nothing for the cycle collector to find
+        gc.disable()
+        try:
+            for fn, (bindings, triples, file_private) in zip(filenames, results):
+                for prefix, namespace in bindings:
+                    self.g.bind(prefix, namespace)
+                if self.private_ids:
+                    triples = (t for t in triples if self.private_ids.isdisjoint(t))
+                self.g.addN((s, p, o, self.g) for s, p, o in triples)
+                logging.info(f"loading rdf from {fn}")
+        finally:
+            gc.enable()
+
+        for i in sorted(set(i for i, source, is_data in jobs)):
+            self._cache_ttl(filenames[i], stats[i], results[i])
 
-        logging.info("** Looking for media in graph **")
+        return self
 
+    def _drop_private(self, private):
+        '''Remember that the entities in private are private, and remove anything already in the graph that mentions them.'''
+        for entity_id in private:
+            logging.info(f"{entity_id}: dropping private entity")
+            self.private_ids.add(entity_id)
+            self.g.remove((entity_id, None, None))
+            self.g.remove((None, entity_id, None))
+            self.g.remove((None, None, entity_id))
 
-        for path, dirs, files in os.walk(src_root, followlinks=True):
-            logging.debug(f"Looking in {path}")
+    def _ttl_cache_path(self, fn):
+        key = hashlib.sha256(os.path.abspath(fn).encode('utf-8')).hexdigest()
+        return os.path.join(self.work_dir, TTL_CACHE_DIR, key+".pickle")
 
-            # this is evil: https://cyluun.github.io/blog/manipulating-python-oswalk
-            # the [:] makes sure dirs is altered in place so that os.walk uses the new one :cackle:
-            dirs[:] = [d for d in dirs if not d.startswith('.') and not d.startswith('_')]
+    def _get_cached_ttl(self, fn, st):
+        '''Return the namespaces, triples and private entities of fn, whose stat is st, from the cache, or None if it has changed since it was cached.'''
+        try:
+            # lots of small objects, none of them garbage
+            gc.disable()
+            try:
+                version, path, size, mtime, id_base, parsed = pickle.load(open(self._ttl_cache_path(fn), "rb"))
+            finally:
+                gc.enable()
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning(f"{fn}: ignoring cached parse: {e}")
+            return None
+
+        if (version, path, size, mtime, id_base) != (TTL_CACHE_VERSION, os.path.abspath(fn), st.st_size, st.st_mtime_ns, self.id_base):
+            return None
+        return parsed
+
+    def _cache_ttl(self, fn, st, parsed):
+        cache_path = self._ttl_cache_path(fn)
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path+".tmp", "wb") as f:
+            pickle.dump((TTL_CACHE_VERSION, os.path.abspath(fn), st.st_size, st.st_mtime_ns, self.id_base, parsed), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(cache_path+".tmp", cache_path)
 
-            for f in files:
-                fullf = os.path.join(path,f)
-                if f.endswith('.ttl'):
-                    self.add_ttl(fullf)
-                else:
-                    # look for renditions of the entities that might be referenced
+    def add_dir(self,src_root):
+        logging.info("** Looking for media in graph **")
 
-                    for pfx, ctx in CONTEXTS.items():
-                        m = re.match("(.*)[.]([^.]*)$",f)
-                        if not m or m.group(2) not in EXTENSIONS:
-                            logging.debug(f"ignoring file without extension: {path}/{f}")
-                            continue
-                        ext = m.group(2)
+        index = SourceIndex(self.work_dir)
+        ttl_files = []
+        media_count = 0
 
+        # renditions are listed in the same order as CONTEXT_FILES
+        targets = [(ctx, self.files[ctx]) for pattern, ctx in CONTEXT_FILES]
 
-                        pm = re.match("(.*)"+pfx+"[.]([^.]*)$",f)
-                        if pm:
-                            entity_id = rdflib.URIRef(urllib.parse.urljoin(self.id_base, path_to_id(path[len(src_root):], urllib.parse.quote(pm.group(1)))))
+        for path, files, remembered in index.scan(src_root):
+            ttl_files += [os.path.join(path,f) for f in files if f.endswith('.ttl')]
 
-                            if not path.startswith(src_root):
-                                raise ValueError(f"expected path under {src_root}, got {path}")
+            # classifying a directory's files only has to be done again when they change
+            key = ('media', self.id_base, src_root)
+            if key not in remembered:
+                remembered[key] = self._find_media(src_root, path, files)
+                index.changed = True
 
-                            logging.info(f"{entity_id}@@{ctx}: adding {fullf}")
-                            self.files[ctx][entity_id] = (fullf, ext, False)
-                            continue
-                        else:
-                            entity_id = rdflib.URIRef(urllib.parse.urljoin(self.id_base, path_to_id(path[len(src_root):], urllib.parse.quote(m.group(1)))))
+            # look for renditions of the entities that might be referenced
+            for fullf, ext, renditions in remembered[key]:
+                media_count += 1
+                for (ctx, ctx_files), (entity_id, needs_conversion) in zip(targets, renditions):
+                    if not needs_conversion:
+                        logging.info(f"{entity_id}@@{ctx}: adding {fullf}")
+                        ctx_files[entity_id] = (fullf, ext, False)
+                    else:
+                        # unless there is already a context-specific file
+                        ctx_files.setdefault(entity_id, (fullf, ext, True))
 
-                            if entity_id in self.files[ctx]:
-                                logging.info(f"{entity_id}@@{ctx}: found a context-specific file")
-                                continue
+        index.save()
+        logging.info(f"Found {media_count} media files in {src_root}")
 
-                            logging.debug(f"{entity_id}@@{ctx}: will convert {fullf}")
-                            self.files[ctx][entity_id] = (fullf, ext, True)
+        self.add_ttls(ttl_files)
 
         return self
 
+    def _find_media(self, src_root, path, files):
+        '''Return (file, ext, renditions) for each media file in the directory path, where renditions is
+        a list of (entity ID, whether it needs converting) for each context in CONTEXT_FILES, that add_dir applies in order.'''
+        if not path.startswith(src_root):
+            raise ValueError(f"expected path under {src_root}, got {path}")
+        rel = path[len(src_root):]
+
+        ids = {}
+        def entity_id(name):
+            if name not in ids:
+                ids[name] = rdflib.URIRef(urllib.parse.urljoin(self.id_base, path_to_id(rel, urllib.parse.quote(name))))
+            return ids[name]
+
+        r = []
+        for f in files:
+            if f.endswith('.ttl'):
+                continue
+
+            m = MEDIA_FILE.match(f)
+            if not m or m.group(2) not in EXTENSIONS:
+                logging.debug(f"ignoring file without extension: {path}/{f}")
+                continue
+
+            renditions = []
+            for pattern, ctx in CONTEXT_FILES:
+                pm = pattern.match(f)
+                if pm:
+                    renditions.append((entity_id(pm.group(1)), False))
+                else:
+                    renditions.append((entity_id(m.group(1)), True))
+            r.append((os.path.join(path,f), m.group(2), renditions))
+        return r
 
-    def _add_markdown_refs(self, content_id, blob):
-        mdproc = markdown.Markdown(extensions=[ImgExtExtension(base=self.id_base), 'tables'])
-        html = mdproc.convert(blob)
-
-        try:
-          imgs = mdproc.images
-        except AttributeError:
-          imgs = []
+    def _markdown_refs(self, blob):
+        '''Return the URLs of the images and of the links in the markdown blob.
+        It is parsed as for an html page, so that the publisher can carry on from the same parse.'''
+        return find_images_and_links(parse_markdown(blob, self.markdown_cache), self.id_base)
 
-        try:
-          links = mdproc.links
-        except AttributeError:
-          links = []
+    def _add_markdown_refs(self, content_id, blob):
+        imgs, links = self._markdown_refs(blob)
 
         for url in imgs:
             uriref = rdflib.URIRef(url)
@@ -314,70 +616,162 @@ class Builder:
         return entity_dir
 
     def _get_converted_file(self, entity_id, entity_dir, fn, ext, ctx, rendition_key, blob_filename):
-        # If there's not an existing file then we have to convert
+        '''Return the path of an existing conversion of fn for ctx, or None if it has to be converted.'''
         existing_converted_path = os.path.join(entity_dir,rendition_key,blob_filename) # FIXME this is a bit spaghetti
-        if not os.path.exists(existing_converted_path):
-            # FIXME: this process doesn't return the converted path above, but just __last_conversion,
-            # and we rely on the blob reading to pick it up and add it, which feels odd
-            return self._convert_file(entity_id, entity_dir, fn, ext, ctx)
 
-        # Assume that if the original file hasn't changed then its conversions are also ok
-        existing_path = os.path.join(entity_dir,"original."+ext)
-
-        r = subprocess.run(["diff", existing_path, fn])
-
-        if r.returncode!=0:
+        if not self.manifest.is_converted(existing_converted_path, self.manifest.file_hash(fn), conversion_command(ext, ctx, self.image_backend)):
             logging.info(f"{entity_id}@@{ctx}: file {fn} has changed")
-            return self._convert_file(entity_id, entity_dir, fn, ext, ctx)
+            return None
 
         logging.debug(f"{entity_id}@@{ctx}: file has not changed")
 
         return existing_converted_path
 
-    def _convert_file(self, entity_id, entity_dir, fn, ext, ctx):
-        converted_file = os.path.join(self.work_dir,"__last_conversion."+ext)
-        logging.info(f"{entity_id}@@{ctx}: converting {fn}")
-        r = subprocess.run(CONVERSIONS[ext][ctx](fn,converted_file))
-        return converted_file
-
-
-    def _add_rendition(self, mediaType, entity_id, rendition_key, blob=None, blob_filename=None, **properties):
-        info_blob = None
-        info = rdflib.Graph()
-        info.bind('', F)
+    def _convert_file(self, job):
+        '''Run one conversion job, returning an error message if it failed.'''
+        logging.info(f"{job['entity_id']}@@{job['ctx']}: converting {job['src']}")
+        if os.path.exists(job['dest']):
+            os.remove(job['dest']) # left over from an interrupted run
+        try:
+            r = subprocess.run(job['command'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as e:
+            return str(e)
 
+        logging.debug(f"{job['entity_id']}@@{job['ctx']}: {r.stdout.decode('utf-8','replace').strip()}")
+        if r.returncode!=0:
+            return f"{job['command'][0]} exited with {r.returncode}: {r.stderr.decode('utf-8','replace').strip()}"
+        if not os.path.exists(job['dest']):
+            return f"{job['command'][0]} didn't write {job['dest']}"
+
+    def _convert_image(self, jobs):
+        '''Run in-process conversion jobs that all have the same source image, so that it only has to be decoded once.
+        Returns an error message (or None) for each job.'''
+        src = jobs[0]['src']
+        logging.info(f"{jobs[0]['entity_id']}: converting {src} for {', '.join(job['ctx'] for job in jobs)}")
+        for job in jobs:
+            if os.path.exists(job['dest']):
+                os.remove(job['dest']) # left over from an interrupted run
+        try:
+            imaging.convert_image(src, [(job['geometry'], job['dest']) for job in jobs])
+        except imaging.NotSupported as e:
+            logging.info(f"{jobs[0]['entity_id']}: {e}, converting with {jobs[0]['command'][0]} instead")
+            return [self._convert_file(job) for job in jobs]
+        except Exception as e:
+            return [f"{e.__class__.__name__}: {e}"] * len(jobs)
+        return [None if os.path.exists(job['dest']) else f"didn't write {job['dest']}" for job in jobs]
+
+    def _convert_batch(self, jobs):
+        if jobs[0]['geometry']:
+            return self._convert_image(jobs)
+        return [self._convert_file(job) for job in jobs]
+
+    def _convert_files(self, jobs):
+        '''Run conversion jobs, self.jobs at a time. Each job gets an 'error', which is None if it succeeded.
+        Jobs write to their own 'dest', so they don't depend on each other, and a failure only affects its own job.
+        In-process image conversions of the same source are run together, as one job.'''
+        batches = []
+        images = {}
+        for job in jobs:
+            if not job['geometry']:
+                batches.append([job])
+            elif job['src'] in images:
+                images[job['src']].append(job)
+            else:
+                images[job['src']] = [job]
+                batches.append(images[job['src']])
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            for batch, errors in zip(batches, pool.map(self._convert_batch, batches)):
+                for job, error in zip(batch, errors):
+                    job['error'] = error
+                    if error:
+                        logging.error(f"{job['entity_id']}@@{job['ctx']}: couldn't convert {job['src']}: {error}")
+
+        failed = sum(1 for job in jobs if job['error'])
+        if failed:
+            logging.warning(f"{failed} of {len(jobs)} conversions failed, their renditions will be missing")
+
+
+    def _write_rendition(self, mediaType, entity_id, rendition_key, blob=None, blob_file=None, blob_hash=None, blob_filename=None, **properties):
+        '''Write a rendition of entity_id and its info into the work dir, ready to be added to IPFS.
+        The content is either blob, or the file blob_file with the content hash blob_hash,
+        which is only read if the rendition has changed.
+        Returns the rendition for _add_rendition, with its IPFS hash if that is already known.'''
         # add everything we know about this entity
-        for p, o in self.g[entity_id]:
-            if p != F.rendition: # we might know about other renditions already, but it's pot luck, so best to keep just this one
-                info.add((entity_id, p, o))
+        # we might know about other renditions already, but it's pot luck, so best to keep just this one
+        info = {(entity_id, p, o) for p, o in self.g[entity_id] if p != F.rendition}
 
         blob_uri = rdflib.URIRef(blob_filename)
         info.add((entity_id, F.rendition, blob_uri)) # relative path to the file, as we don't know the hash
         info.add((blob_uri, F.mediaType, mediaType))
 
-        info_blob = info.serialize(format='ttl')
+        # sorted N-Triples (which are also Turtle), so that the same info always makes the same file
+        info_blob = ''.join(sorted(nt_row(t) for t in info)).encode('utf-8')
 
         entity_dir = self._make_entity_dir(entity_id, rendition_key)
 
-        if info_blob:
-          open(os.path.join(entity_dir,"info.ttl"),"wb").write(info_blob)
-
         blob_path = os.path.join(entity_dir,blob_filename)
-        ipfs_hash = get_existing_hash(blob, entity_dir, blob_path)
-
-        if not ipfs_hash:
+        if blob_hash is None:
+            blob_hash = content_hash(blob)
+        info_hash = content_hash(info_blob)
+
+        # rewriting an unchanged file would only change its mtime
+        info_path = os.path.join(entity_dir,"info.ttl")
+        if not (os.path.exists(info_path) and self.manifest.file_hash(info_path) == info_hash):
+            open(info_path,"wb").write(info_blob)
+            self.manifest.wrote(info_path, info_hash)
+
+        # the IPFS hash covers the whole directory, so it changes with either the blob or the info
+        ipfs_hash = None
+        if os.path.exists(blob_path) and self.manifest.file_hash(blob_path) == blob_hash:
+            ipfs_hash = self.manifest.rendition_hash(entity_dir, blob_hash, info_hash, self.ipfs_add)
+
+        if not ipfs_hash and blob_file != blob_path:
+            if blob is None:
+                blob = open(blob_file,"rb").read()
             open(blob_path,"wb").write(blob)
-            ipfs_hash = ipfs_add_dir(entity_dir)
-            open(entity_dir+".ipfs-hash","wb").write(ipfs_hash)
+            self.manifest.wrote(blob_path, blob_hash)
+
+        return {
+            'entity_id': entity_id,
+            'entity_dir': entity_dir,
+            'mediaType': mediaType,
+            'blob_filename': blob_filename,
+            'blob_hash': blob_hash,
+            'info_hash': info_hash,
+            'ipfs_hash': ipfs_hash,
+            'properties': properties
+        }
 
-        ipfs_id = IPFS[ipfs_hash.decode("us-ascii")+"/"+blob_filename]
+    def _hash_renditions(self, renditions):
+        '''Find the IPFS hashes of all the renditions that don't have one yet, in one go.'''
+        todo = [r for r in renditions if not r['ipfs_hash']]
+        if not todo:
+            return
+
+        if self.ipfs_add:
+            hashes = [ipfs_add_dir(r['entity_dir']).decode("us-ascii") for r in todo]
+        else:
+            hashes = hash_dirs([r['entity_dir'] for r in todo], self.jobs)
+            logging.info(f"Hashed {len(todo)} renditions")
+
+        for r, ipfs_hash in zip(todo, hashes):
+            logging.debug(f"{ipfs_hash} from {r['entity_dir']}")
+            r['ipfs_hash'] = ipfs_hash
+            if ipfs_hash:
+                self.manifest.added_rendition(r['entity_dir'], r['blob_hash'], r['info_hash'], ipfs_hash, self.ipfs_add)
+
+    def _add_rendition(self, r):
+        '''Add a rendition from _write_rendition, which must have an IPFS hash by now, to the graph.'''
+        entity_id, mediaType = r['entity_id'], r['mediaType']
+        ipfs_id = IPFS[r['ipfs_hash']+"/"+r['blob_filename']]
 
         self.g.add((ipfs_id, RDF.type, F.Media))
         self.g.add((ipfs_id, F.mediaType, mediaType))
         self.g.add((ipfs_id, F.blobURL, ipfs_id)) # in IPFS, IDs and URLs are the same thing
-        self.g.add((ipfs_id, F.localPath, rdflib.Literal(entity_dir))) # used (and removed) by the publisher to avoid IPFS round trips
+        self.g.add((ipfs_id, F.localPath, rdflib.Literal(r['entity_dir']))) # used (and removed) by the publisher to avoid IPFS round trips
 
-        for k, v in properties.items():
+        for k, v in r['properties'].items():
             logging.debug(f"{entity_id}: adding property {k}={v}")
             self.g.add((ipfs_id, F[k], v))
         self.g.add((entity_id, F.rendition, ipfs_id))
@@ -387,17 +781,8 @@ class Builder:
     def build(self):
         self.g.bind('ipfs', IPFS)
 
-        # first remove all private stuff, we don't want to know about it, convert it, or add it to IPFS
-        self.private_ids = set()
-
-        logging.debug( list(self.g.triples((None, F.hasAvailability, F.private))) )
-        for triple in self.g.triples((None, F.hasAvailability, F.private)):
-            entity_id = triple[0]
-            logging.info(f"{entity_id}: dropping private entity")
-            self.private_ids.add(entity_id)
-            self.g.remove((entity_id, None, None))
-            self.g.remove((None, entity_id, None))
-            self.g.remove((None, None, entity_id))
+        # private entities loaded from TTL are already gone, but anything else added to the graph still has to be checked
+        self._drop_private(set(self.g.subjects(F.hasAvailability, F.private)))
 
         self.entities = {} # id: savedir hint
         self.content = set()
@@ -453,8 +838,10 @@ class Builder:
 
                 self._add_markdown_refs(s, o)
 
-        originals_to_copy = {}
-       
+        # Plan every rendition first, so that all the conversions can run at once
+        planned = []
+        conversions = []
+
         for ctx, id_to_file in self.files.items():
             for entity_id, (fn, ext, needs_conversion) in id_to_file.items():
                 if entity_id not in self.valid_contexts:
@@ -468,6 +855,7 @@ class Builder:
 
                 blob_filename = posixpath.basename(entity_id)+"."+ext
 
+                job = None
                 if needs_conversion:
                     if ext not in CONVERSIONS:
                         logging.warning(f"{entity_id}: no conversions available for {EXTENSIONS[ext]}")
@@ -477,37 +865,72 @@ class Builder:
                         continue
 
                     entity_dir = self._make_entity_dir(entity_id)
-                    if fn not in originals_to_copy:
-                        originals_to_copy[fn] = os.path.join(entity_dir,"original."+ext)
-
-                    fn = self._get_converted_file(entity_id, entity_dir, fn, ext, ctx, rendition_key, blob_filename)
-
+                    converted_file = self._get_converted_file(entity_id, entity_dir, fn, ext, ctx, rendition_key, blob_filename)
+                    if converted_file is None:
+                        converted_file = os.path.join(self.work_dir,f"__conversion-{len(conversions)}.{ext}")
+                        job = {
+                            'entity_id': entity_id,
+                            'ctx': ctx,
+                            'src': fn,
+                            'dest': converted_file,
+                            'command': CONVERSIONS[ext][ctx](fn,converted_file),
+                            'geometry': image_geometry(ext, ctx, self.image_backend),
+                            # recorded in the manifest if the conversion succeeds
+                            'converted_path': os.path.join(entity_dir,rendition_key,blob_filename),
+                            'src_hash': self.manifest.file_hash(fn),
+                            'signature': conversion_command(ext, ctx, self.image_backend)
+                        }
+                        conversions.append(job)
+                    fn = converted_file
+
+                planned.append((entity_id, ctx, fn, ext, blob_filename, rendition_key, job))
+
+        self._convert_files(conversions)
+
+        for entity_id, ctx, fn, ext, blob_filename, rendition_key, job in planned:
+            if job and job['error']:
+                continue
+
+            # Fresh conversions are read now, as they are about to be moved into place anyway.
+            # Anything else is recognised by its size and mtime, and only read if its rendition has to be added again.
+            if job or EXTENSIONS[ext] == 'text/markdown':
                 blob = open(fn,'rb').read()
-                logging.debug(f"{entity_id}: found rendition at {fn}")
-                renditions_to_add.append({
-                    'entity_id': entity_id,
-                    'blob': blob,
-                    'blob_filename': blob_filename,
-                    'rendition_key': rendition_key,
-                    'mediaType': rdflib.Literal(EXTENSIONS[ext]),
-                    'charset': rdflib.Literal("utf-8"),
-                    'intendedUse': ctx
-                })
-
-                if EXTENSIONS[ext] == 'text/markdown':
-                    if not blob:
-                        blob = open(fn,'rb').read()
-                    self._add_markdown_refs(content_id, blob.decode('utf-8'))
-
-        # now all contexts are converted, we can copy the new originals
-        for src, dest in originals_to_copy.items():
-            subprocess.run(["cp",src,dest])
+                blob_hash = content_hash(blob)
+            else:
+                blob = None
+                blob_hash = self.manifest.file_hash(fn)
+            logging.debug(f"{entity_id}: found rendition at {fn}")
+            renditions_to_add.append({
+                'entity_id': entity_id,
+                'blob': blob,
+                'blob_file': fn,
+                'blob_hash': blob_hash,
+                'blob_filename': blob_filename,
+                'rendition_key': rendition_key,
+                'mediaType': rdflib.Literal(EXTENSIONS[ext]),
+                'charset': rdflib.Literal("utf-8"),
+                'intendedUse': ctx
+            })
+
+            if EXTENSIONS[ext] == 'text/markdown':
+                if not blob:
+                    blob = open(fn,'rb').read()
+                self._add_markdown_refs(content_id, blob.decode('utf-8'))
+
+            if job:
+                os.remove(fn)
+                renditions_to_add[-1]['blob_file'] = None
+                self.manifest.converted(job['converted_path'], job['src_hash'], job['signature'])
 
         # markdown properties have all been converted or discarded
         self.g.remove((None, F.markdown, None))
 
         # graph is now ready
-        for r in renditions_to_add:
-            blob_id = self._add_rendition(**r)
+        renditions = [self._write_rendition(**r) for r in renditions_to_add]
+        self._hash_renditions(renditions)
+        for r in renditions:
+            blob_id = self._add_rendition(r)
+
+        self.manifest.save()
 
         return self.g
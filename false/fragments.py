@@ -0,0 +1,52 @@
+#!/usr/bin/python3
+
+import logging, collections
+
+# How much rendered output to keep for pages to include, in characters
+FRAGMENT_STORE_SIZE = 64 << 20
+
+class FragmentStore:
+    '''Pages that have been written, kept in memory so that the pages that include them don't have to read them back.
+    Pages are kept by (entity, context). Once they add up to more than size characters,
+    the least recently used are forgotten, and read back from their files if they are needed again.'''
+
+    def __init__(self, size=FRAGMENT_STORE_SIZE):
+        self.size = size
+        self.used = 0
+        self.fragments = collections.OrderedDict() # (entity, context): content, least recently used first
+        self.hits = self.misses = 0
+
+    def put(self, key, content):
+        '''Keep content, which has just been written, as the page for key.'''
+        self.discard(key)
+        if len(content) > self.size:
+            return
+        self.fragments[key] = content
+        self.used += len(content)
+        while self.used > self.size:
+            k, c = self.fragments.popitem(last=False)
+            self.used -= len(c)
+
+    def get(self, key, fn):
+        '''Return the page for key, reading it from fn if it isn't kept.
+        Raises FileNotFoundError if it isn't kept and fn doesn't exist.'''
+        content = self.fragments.get(key)
+        if content is not None:
+            self.fragments.move_to_end(key)
+            self.hits += 1
+            return content
+
+        self.misses += 1
+        with open(fn,'r') as f:
+            content = f.read()
+        self.put(key, content)
+        return content
+
+    def discard(self, key):
+        '''Forget the page for key, which has gone or is about to change.'''
+        content = self.fragments.pop(key, None)
+        if content is not None:
+            self.used -= len(content)
+
+    def report(self):
+        logging.info(f"Fragment store: {self.hits} hits, {self.misses} read from files, {len(self.fragments)} kept ({self.used} characters)")
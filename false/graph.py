@@ -1,6 +1,6 @@
 #!/usr/bin/python3
 
-import rdflib, re, os, logging, types
+import rdflib, re, os, sys, logging, types, functools
 
 from rdflib.namespace import RDF, OWL, SKOS
 
@@ -8,9 +8,39 @@ from rdflib.namespace import RDF, OWL, SKOS
 # They won't collide, because these are context names, not property names (embedHTML etc. are the properties)
 CONTEXTS_AS_PROPS = { 'page', 'embed', 'teaser', 'link' }
 
+# Upper bound on the number of IRI -> safe name mappings remembered per graph
+SAFE_PATH_CACHE_SIZE = 262144
+
+UNSAFE_CHARS = re.compile('[^A-Za-z0-9-]')
+
+# Upper bound on the number of projections and sort orders remembered by each TemplatableSet, and sort keys by each entity
+MEMO_SIZE = 32
+
+# op and so adjacency is held in tuples up to this size, then in a set
+ADJACENCY_TUPLE_MAX = 4
+
+# Transitive closures of these predicates are computed once when the graph is built
+CLOSURE_PREDICATES = ('rdfs_subClassOf', 'rdfs_subPropertyOf')
+
+# Bump this whenever the pickled form of TemplatableGraph changes, see TemplatableGraph.__getstate__
+PICKLE_FORMAT = 2
+
+# Counts attribute lookups when set, see false.profiler
+profiler = None
+
+def set_profiler(p):
+    global profiler
+    profiler = p
+
 class RequiredAttributeError(AttributeError):
     pass
 
+def remember(memo, k, v):
+    '''Put v in the dict memo under k, first forgetting the oldest entry if memo already holds MEMO_SIZE.'''
+    if k not in memo and len(memo) >= MEMO_SIZE:
+        del memo[next(iter(memo))]
+    memo[k] = v
+
 class TemplatableSet(set):
     '''This set can be referenced in templates.
     If there are multiple items in the set they are concatenated with space separators.
@@ -19,6 +49,15 @@ class TemplatableSet(set):
     The rationale is that by traversing the graph of entities you will end up at a set of sets of literals,
     which will be the thing you want to display.'''
 
+    __slots__ = ('projections', 'generations')
+
+    def __init__(self, *args):
+        set.__init__(self, *args)
+        # {attribute: (generation, projected set)}, see get()
+        self.projections = None
+        # the attribute generations of the graph that the entities in this set belong to, see graphGenerations()
+        self.generations = None
+
     def __str__(self):
         return ' '.join(str(i) for i in self)
 
@@ -53,41 +92,42 @@ class TemplatableSet(set):
         '''Coerce self into a float, averaging if necessary.'''
         return sum([float(i) for i in self]) / len(self)
 
+    def graphGenerations(self):
+        '''Return the attribute generations of the graph that the entities in this set belong to.
+        A set with no entities in it doesn't depend on any graph, so its projections never go stale that way.'''
+        if self.generations is None:
+            for i in self:
+                if isinstance(i, TemplatableEntity):
+                    self.generations = i.generations
+                    return self.generations
+            return NO_GENERATIONS
+        return self.generations
+
     def sort(self, reverse, *properties):
-        '''Return an iterator over the objects in self in alphabetical order of properties in turn.'''
-
-        class After:
-            '''If a property in the list is not present, we want to sort that item after items with the property.'''
-            def __lt__(self, other): return False
-            def __gt__(self, other): return True
-            def __str__(self): return ''
-        class Before:
-            '''If a property in the list is not present, we want to sort that item after items with the property, even if reversed.'''
-            def __lt__(self, other): return True
-            def __gt__(self, other): return False
-            def __str__(self): return ''
-  
+        '''Return an iterator over the objects in self in alphabetical order of properties in turn.
+        The order is remembered until this set changes, or any entity in the graph gains or loses one of the properties,
+        and each entity remembers its own sort key in the same way, see TemplatableEntity.sortKey.'''
+        if not self:
+            return iter(()) # nothing to remember, and the shared EMPTY would remember it forever
+
+        token = sort_token(self.graphGenerations(), properties)
+        k = ('sort', reverse) + properties # can't collide with the attribute names that get() uses
+        if self.projections is not None:
+            hit = self.projections.get(k)
+            if hit is not None and hit[0] == token:
+                return iter(hit[1])
+
         if reverse:
-            AFTER = Before()
+            after = SORT_BEFORE
         else:
-            AFTER = After()
+            after = SORT_AFTER
 
-        s = {}
-        for i in self:
-            k = []
-            for p in properties:
-                pv = i.get(p)
-                if pv:
-                    k.append(str(pv))
-                else:
-                    k.append(AFTER)
-            k = tuple(k)
-            if k not in s:
-                s[k] = []
-            s[k].append(i)
-        for k in sorted(s.keys(), reverse=reverse):
-            for i in s[k]:
-                yield i
+        r = sorted(self, key=lambda i: i.sortKey(properties, after, token), reverse=reverse)
+
+        if self.projections is None:
+            self.projections = {}
+        remember(self.projections, k, (token, r))
+        return iter(r)
 
     def pick(self):
         '''Return one of the items in the set, don't care which.'''
@@ -99,7 +139,6 @@ class TemplatableSet(set):
         s = self.get(a)
 
         if not s:
-            logging.debug('%s: no set items had required property %s' % (repr(self),a))
             raise RequiredAttributeError('no set items had required property %s' % a)
 
         return s
@@ -116,10 +155,27 @@ class TemplatableSet(set):
         return r.replace('&','&amp;').replace('<','&lt;')
 
     def get(self, a):
-        '''Return a TemplatableSet for an attribute, empty or otherwise.'''
+        '''Return a TemplatableSet for an attribute, empty or otherwise.
+        The result is remembered until this set changes, or any entity in the graph gains or loses a value for a,
+        so repeated paths like e.rendition.blobURL are only projected once. It is shared, so it can't be modified.
+        Each set remembers up to MEMO_SIZE results, along with its sort orders, forgetting the oldest first.'''
         # This is used inside __getattr__ so we cannot raise AttributeError
         # (it will get mysteriously swallowed, even if unrelated to self)
-        s = TemplatableSet()
+        if not self:
+            # nothing to remember, and the shared EMPTY would remember every attribute ever asked of it
+            if profiler is not None:
+                profiler.count(self, a, EMPTY)
+            return EMPTY
+
+        generation = self.graphGenerations().get(a, 0)
+        if self.projections is not None:
+            hit = self.projections.get(a)
+            if hit is not None and hit[0] == generation:
+                if profiler is not None:
+                    profiler.count(self, a, hit[1])
+                return hit[1]
+
+        s = set()
         for i in self:
             if hasattr(i, a):
                 g = getattr(i, a)
@@ -132,6 +188,17 @@ class TemplatableSet(set):
             else:
                 pass # this setelement didn't have the requested attribute :shrug:
 
+        if s:
+            s = FrozenTemplatableSet(s)
+        else:
+            s = EMPTY
+
+        if self.projections is None:
+            self.projections = {}
+        remember(self.projections, a, (generation, s))
+
+        if profiler is not None:
+            profiler.count(self, a, s)
         return s
 
     def count(self, a):
@@ -159,12 +226,160 @@ class TemplatableSet(set):
 
         s = self.get(a)
         if not s:
-            logging.debug('%s: no set items had required property %s' % (repr(self),a))
             raise AttributeError(a)
         return s
 
+class FrozenTemplatableSet(TemplatableSet):
+    '''A TemplatableSet that refuses to change, so that one instance can be shared.'''
+
+    __slots__ = ()
+
+    def refuse(self, *args, **kwargs):
+        raise TypeError('this TemplatableSet is shared and cannot be modified')
+
+    add = discard = remove = pop = clear = refuse
+    update = difference_update = intersection_update = symmetric_difference_update = refuse
+    __ior__ = __iand__ = __isub__ = __ixor__ = refuse
+
+# Returned for every missing property, instead of a fresh empty set each time
+EMPTY = FrozenTemplatableSet()
+
+class SortAfter:
+    '''If a property in the list is not present, we want to sort that item after items with the property.'''
+    def __lt__(self, other): return False
+    def __gt__(self, other): return True
+    def __str__(self): return ''
+
+class SortBefore:
+    '''If a property in the list is not present, we want to sort that item after items with the property, even if reversed.'''
+    def __lt__(self, other): return True
+    def __gt__(self, other): return False
+    def __str__(self): return ''
+
+# These stand in for missing properties in sort keys. There is one of each, so that remembered keys compare equal.
+SORT_AFTER = SortAfter()
+SORT_BEFORE = SortBefore()
+
+# The attribute generations of a set with no entities in it, which never change
+NO_GENERATIONS = types.MappingProxyType({})
+
+def sort_token(generations, properties):
+    '''Return a value that changes whenever a sort key on properties might have, given a graph's attribute generations.
+    rdf_type is included, because an entity's string form depends on whether it has a type.'''
+    return tuple(generations.get(p, 0) for p in properties) + (generations.get('rdf_type', 0),)
+
+def add_adjacent(d, k, v):
+    '''Add v to the collection d[k].
+    Small collections are tuples, which are much smaller than sets; they become sets as they grow.'''
+    c = d.get(k)
+    if c is None:
+        d[k] = (v,)
+    elif isinstance(c, tuple):
+        if v in c:
+            return
+        if len(c) < ADJACENCY_TUPLE_MAX:
+            d[k] = c + (v,)
+        else:
+            d[k] = TemplatableSet(c + (v,))
+    else:
+        c.add(v)
+        c.projections = None
+
+def adjacent(items):
+    '''Return distinct items as the collection that add_adjacent would have built from them one by one.'''
+    if len(items) > ADJACENCY_TUPLE_MAX:
+        return TemplatableSet(items)
+    return tuple(items)
+
+def remove_adjacent(d, k, v):
+    '''Remove v from the collection d[k], as created by add_adjacent, and d[k] itself if that empties it.'''
+    c = d[k]
+    if isinstance(c, tuple):
+        if v not in c:
+            raise KeyError(v)
+        c = tuple(x for x in c if x != v)
+        d[k] = c
+    else:
+        c.remove(v)
+        c.projections = None
+    if not c:
+        del d[k]
+
+def strongly_connected(nodes, successors):
+    '''Tarjan's algorithm without recursion, so deep hierarchies can't blow the stack.
+    Yields each strongly connected component as a list, after every component reachable from it.'''
+    index = {}
+    low = {}
+    stack = []
+    on_stack = set()
+
+    for root in nodes:
+        if root in index:
+            continue
+        index[root] = low[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(successors(root)))]
+
+        while work:
+            v, it = work[-1]
+            for w in it:
+                if w not in index:
+                    index[w] = low[w] = len(index)
+                    stack.append(w)
+                    on_stack.add(w)
+                    work.append((w, iter(successors(w))))
+                    break
+                elif w in on_stack:
+                    low[v] = min(low[v], index[w])
+            else:
+                work.pop()
+                if work:
+                    u = work[-1][0]
+                    low[u] = min(low[u], low[v])
+                if low[v] == index[v]:
+                    component = []
+                    while True:
+                        w = stack.pop()
+                        on_stack.discard(w)
+                        component.append(w)
+                        if w is v:
+                            break
+                    yield component
+
+class NamespaceIndex:
+    '''Finds the namespace binding for an IRI without scanning every binding.
+    The answer is the same as a linear scan over graph.namespaces() would give,
+    i.e. the first binding that matches wins, not necessarily the longest.'''
+
+    def __init__(self, namespaces):
+        self.bindings = {}
+        for rank, (px, n) in enumerate(namespaces):
+            n = str(n)
+            if n not in self.bindings:
+                self.bindings[n] = (rank, px)
+        self.lengths = sorted({len(n) for n in self.bindings})
+
+    def match(self, p):
+        '''Return (prefix, namespace length) for the binding that matches p, or None.'''
+        best = None
+        for l in self.lengths:
+            if l > len(p):
+                break
+            b = self.bindings.get(p[:l])
+            if b is not None and (best is None or b[0] < best[0]):
+                best = (b[0], b[1], l)
+        if best is None:
+            return None
+        return best[1:]
+
 class TemplatableEntity:
-    def __init__(self, s, safe):
+    # Entities are numerous, so they don't get a __dict__.
+    # asEmbed and language are only set for literals; when unset, lookups fall through to __getattr__ as usual.
+    # so is only set for predicates. It lives here so that an entity can become a predicate in place.
+    __slots__ = ('id', 'safe', 'po', 'op', 'so', 'closures', 'generations', 'typeCache', 'sortKeys', 'asEmbed', 'language')
+
+    def __init__(self, s, safe, closures=None, generations=None):
         if isinstance(s, rdflib.BNode):
             # this is a bit nasty, but
             # in order to reference blank nodes in internally-generated src attributes,
@@ -182,6 +397,17 @@ class TemplatableEntity:
         self.po = {'this': self}
         self.op = {}
 
+        # shared with the graph: {predicate safe name: {entity safe name: TemplatableSet}}
+        if closures is None:
+            closures = {}
+        self.closures = closures
+        # shared with the graph: {attribute: generation}, see touch
+        if generations is None:
+            generations = {}
+        self.generations = generations
+        self.typeCache = None
+        self.sortKeys = None # {(properties, missing placeholder): (sort token, key)}, see sortKey
+
     def isBlankNode(self):
         return self.id.startswith('_:')
 
@@ -211,44 +437,90 @@ class TemplatableEntity:
         return r.replace('&','&amp;').replace('<','&lt;')
 
     def walk(self, p):
-        r = TemplatableSet()
-        if p not in self.po:
-            return r
+        '''Return everything reachable from this entity by following p one or more times.
+        For CLOSURE_PREDICATES this is a lookup in the graph's closure index, and the
+        returned set is shared, so don't modify it.'''
+        if p in self.closures:
+            return self.closures[p].get(self.safe, EMPTY)
 
-        for o in self.po[p]:
-            r.add(o)
-            r.update(o.walk(p))
+        r = TemplatableSet()
+        todo = [self]
+        while todo:
+            for o in todo.pop().po.get(p, ()):
+                if isinstance(o, TemplatableEntity) and o not in r:
+                    r.add(o)
+                    todo.append(o)
 
         return r
 
     def render(self, template):
         return template.render(self.po)
 
+    def touch(self, a):
+        '''Note that some entity in the graph has gained or lost a value for a, so that projections of a go stale.'''
+        self.generations[a] = self.generations.get(a, 0) + 1
+
+    def typeInfo(self):
+        '''Return (safe names of all types, most specific types).
+        Classes in a subClassOf cycle are equally specific, so all of them are kept.
+        This is cached until rdf_type is added or wiped, or the class hierarchy is recomputed.'''
+        hierarchy = self.closures.get('rdfs_subClassOf')
+        c = self.typeCache
+        if c is None or c[0] is not hierarchy:
+            directTypes = self.po.get('rdf_type', EMPTY)
+            parentTypes = TemplatableSet()
+            for t in directTypes:
+                # members of a class cycle reach each other, but none of them is a parent of the others
+                parentTypes.update(p for p in t.walk('rdfs_subClassOf') if t not in p.walk('rdfs_subClassOf'))
+            c = (hierarchy, frozenset(x.safe for x in directTypes), FrozenTemplatableSet(directTypes.difference(parentTypes)))
+            self.typeCache = c
+        return c[1:]
+
+    def sortKey(self, properties, after, token):
+        '''Return the key that TemplatableSet.sort orders self by, with after in place of missing properties.
+        It is remembered until token, from sort_token(properties), changes.'''
+        k = (properties, after)
+        if self.sortKeys is None:
+            self.sortKeys = {}
+        else:
+            hit = self.sortKeys.get(k)
+            if hit is not None and hit[0] == token:
+                return hit[1]
+
+        r = []
+        for p in properties:
+            pv = self.get(p)
+            if pv:
+                r.append(str(pv))
+            else:
+                r.append(after)
+        r = tuple(r)
+        remember(self.sortKeys, k, (token, r))
+        return r
+
     def is_type(self, t):
-        return t in [x.safe for x in self.get('rdf_type')]
+        return t in self.typeInfo()[0]
 
     def is_any_type(self, tt):
+        safes = self.typeInfo()[0]
         for t in tt:
-            if self.is_type(t):
+            if t in safes:
                 return True
         return False
 
     def type(self):
-        directTypes = self.get('rdf_type')
-        parentTypes = TemplatableSet()
-        for t in directTypes:
-            parentTypes.update(t.walk('rdfs_subClassOf'))
-        return directTypes.difference(parentTypes)
+        '''The most specific types of this entity. The set is shared, so it can't be modified.'''
+        return self.typeInfo()[1]
 
     def type_id(self):
         return self.type().pick().id
 
     def rels(self, o):
-        return TemplatableSet(p for p in self.op.get(o.safe, []))
+        return TemplatableSet(self.op.get(o.safe, ()))
 
     def rel(self, o):
         leaves = self.rels(o)
-        for p in self.op.get(o.safe, []):
+        for p in self.op.get(o.safe, ()):
             parents = p.walk('rdfs_subPropertyOf')
             for parent in parents:
                 leaves.discard(parent)
@@ -263,22 +535,39 @@ class TemplatableEntity:
         if p.safe not in self.po:
             self.po[p.safe] = TemplatableSet()
         self.po[p.safe].add(o)
+        self.po[p.safe].projections = None
+        self.touch(p.safe)
+
+        if p.safe == 'rdf_type':
+            self.typeCache = None
+
+        if not isinstance(o, rdflib.Literal):
+            add_adjacent(self.op, o.safe, p)
+
+    def remove(self, p, o):
+        s = self.po[p.safe]
+        s.remove(o)
+        if s:
+            s.projections = None
+        else:
+            del self.po[p.safe]
+        self.touch(p.safe)
+
+        if p.safe == 'rdf_type':
+            self.typeCache = None
 
         if not isinstance(o, rdflib.Literal):
-            if o.safe not in self.op:
-                self.op[o.safe] = TemplatableSet()
-            self.op[o.safe].add(p)
+            remove_adjacent(self.op, o.safe, p)
 
     def get(self, a):
         if a in CONTEXTS_AS_PROPS:
-            logging.debug('%s: constructing false-content %s' % (self.id, a))
-            return '<false-content alt="%s property" context="http://id.colourcountry.net/false/%s" src="%s"> ' % (a, a, self.id)
+            r = '<false-content alt="%s property" context="http://id.colourcountry.net/false/%s" src="%s"> ' % (a, a, self.id)
+        else:
+            r = self.po.get(a, EMPTY)
 
-        try:
-            return self.po[a]
-        except KeyError:
-            logging.debug("%s: didn't have property %s" % (repr(self),a))
-            return TemplatableSet()
+        if profiler is not None:
+            profiler.count(self, a, r)
+        return r
 
     def __getattr__(self, a):
         if a=="__html__":
@@ -288,7 +577,6 @@ class TemplatableEntity:
 
         r = self.get(a)
         if not r:
-            logging.debug("%s: didn't have property %s" % (repr(self),a))
             raise AttributeError(a)
         return r
 
@@ -309,8 +597,10 @@ class TemplatableEntity:
         return "<Entity %s %s (%s)>" % (self.id, id(self), self.safe)
 
 class TemplatablePredicate(TemplatableEntity):
-    def __init__(self, p, safe):
-        TemplatableEntity.__init__(self, p, safe)
+    __slots__ = ()
+
+    def __init__(self, p, safe, closures=None, generations=None):
+        TemplatableEntity.__init__(self, p, safe, closures, generations)
         self.so = {}
 
     def __str__(self):
@@ -325,28 +615,52 @@ class TemplatablePredicate(TemplatableEntity):
         if not (isinstance(s, TemplatableEntity) or isinstance(s, rdflib.Literal)):
             raise ValueError("Must add TemplatableEntity or Literal to graph, not %s %s" % (s.__class__.__name__, s))
 
-        if s.safe not in self.so:
-            self.so[s.safe] = TemplatableSet()
-        self.so[s.safe].add(o)
+        add_adjacent(self.so, s.safe, o)
+        self.touch(self.safe)
+
+    def removeso(self, s, o):
+        remove_adjacent(self.so, s.safe, o)
+        self.touch(self.safe)
 
 class TemplatableGraph:
-    def __init__(self, g=None):
+    def __init__(self, g=None, triples=None):
+        '''Build the templatable graph in a single pass over triples, which defaults to g itself.
+        triples can be any iterable of (s, p, o), such as the output of a parser,
+        in which case g only has to supply the namespace bindings.'''
         if g is None:
-            self.g = Graph()
+            self.g = rdflib.Graph()
         else:
             self.g = g
             logging.debug("Found namespaces: %s" % '\n'.join([str(x) for x in self.g.namespaces()]))
 
+        if triples is None:
+            triples = self.g
+
         self.entities = {}
         self.predicates = {}
         self.inv_predicates = {}
+        self.closures = {}
+        self.generations = {} # {attribute: generation}, shared with every entity, see TemplatableEntity.touch
+
+        # Entries (subject safe, predicate safe, object safe or Literal) that exist only by inference,
+        # with the number of inferences that support each one. Anything else was asserted.
+        self.inferred = {}
 
-        # Get predicate information we'll need to build the graph
+        # The triples asserted with a predicate that is symmetric or has a declared inverse, as entries.
+        # Only these can't be told apart from the inverse of a triple asserted the other way round.
+        self.asserted = set()
+
+        self.nsIndex = None
+        self.safePathCache = functools.lru_cache(maxsize=SAFE_PATH_CACHE_SIZE)(self.computeSafePath)
 
         # this one is an axiom
         self.addPredicate(OWL['inverseOf'], OWL['inverseOf'])
 
-        for s, p, o in g:
+        # Inverses can't be added until every predicate declaration has been seen,
+        # so keep the asserted triples, already resolved to entities, for afterwards.
+        asserted = []
+
+        for s, p, o in triples:
             # look for statements about predicates
             if p == RDF['type']:
                 if o == OWL['SymmetricProperty']:
@@ -356,50 +670,67 @@ class TemplatableGraph:
             elif p == OWL['inverseOf']:
                 self.addPredicate(s, o)
 
-        for s, p, o in g:
-            self.addPredicate(p)
+            tes = self.entityFor(s)
+            tep = self.addPredicate(p)
+            if not isinstance(o, rdflib.Literal):
+                o = self.entityFor(o)
 
-        self.addInversePredicates()
+            self.addLink(tes, tep, o, inverse=False)
+            asserted.append((tes, tep, o))
 
-        # Add in the actual graph
-        for s, p, o in g:
-            self.add(s, p, o)
+        self.addInversePredicates()
 
-        inferredTriples = []
+        declared = {sp for sp, tep in self.predicates.items() if self.hasDeclaredInverse(tep)}
+        for tes, tep, o in asserted:
+            if not isinstance(o, rdflib.Literal):
+                self.addInverse(tes, tep, o)
+                if tep.safe in declared:
+                    self.asserted.add(self.entryKey(tes, tep, o))
 
-        # Add inferred predicates
-        for s, p, o in g:
-            sp = self.safePath(p)
+        for sp in CLOSURE_PREDICATES:
+            self.computeClosure(sp)
 
-            if sp in self.entities:
-                supers = self.entities[sp].walk('rdfs_subPropertyOf')
-                for pp in supers:
-                    inferredTriples.append((s, pp.id, o))
+        del asserted
 
-        # Add inferred types
-        for s in self.entities.values():
-            for t in s.po.get('rdf_type',[]):
-                for tt in self.entities[t.safe].walk('rdfs_subClassOf'):
-                    inferredTriples.append((s.id, self.predicates['rdf_type'].id, tt.id))
+        # Add inferred predicates and types
+        for tes in list(self.entities.values()):
+            for tep, o in self.infer(tes):
+                self.addInferred(tes, tep, o)
 
-        for s, p, o in inferredTriples:
-            self.add(s, p, o)
+        for sp in CLOSURE_PREDICATES:
+            self.computeClosure(sp)
 
     def safePath(self, p):
-        for (px, n) in self.g.namespaces():
-            if p.startswith(n):
-                if px=='':
-                    p = p[len(n):]
-                    break
-                else:
-                    p = px+'_'+p[len(n):]
-                    break
-        else:
-            if p.startswith("_:"): # blank nodes
-                p = p[2:]
+        return self.safePathCache(str(p))
+
+    def computeSafePath(self, p):
+        if self.nsIndex is None:
+            self.nsIndex = NamespaceIndex(self.g.namespaces())
+
+        m = self.nsIndex.match(p)
+        if m is not None:
+            px, l = m
+            if px=='':
+                p = p[l:]
+            else:
+                p = px+'_'+p[l:]
+        elif p.startswith("_:"): # blank nodes
+            p = p[2:]
 
         # FIXME: prefixes and protocols can collide
-        return re.sub('[^A-Za-z0-9-]','_',p)
+        # interned, because safe names are used as keys in every entity's po and op
+        return sys.intern(UNSAFE_CHARS.sub('_',p))
+
+    def bind(self, prefix, namespace, **kwargs):
+        '''Bind a namespace on the underlying graph. Safe names computed from now on will use it.'''
+        self.g.bind(prefix, namespace, **kwargs)
+        self.resetNamespaces()
+
+    def resetNamespaces(self):
+        '''Forget the namespace index and cached safe names.
+        Call this if namespaces have been bound directly on self.g.'''
+        self.nsIndex = None
+        self.safePathCache.cache_clear()
 
     def __contains__(self, e):
         return (e in self.entities)
@@ -409,36 +740,150 @@ class TemplatableGraph:
             return self.entities[a]
         raise AttributeError(a)
 
+    def __getstate__(self):
+        '''Pickle the entities as flat tuples that refer to each other by safe name.
+        Pickling the entities themselves would recurse along every link in the graph.
+        Closures, caches and inverse links are rebuilt on unpickling.'''
+        entities = []
+        for e in self.entities.values():
+            po = []
+            for ps, oo in e.po.items():
+                if ps != 'this':
+                    po.append((ps, [o if isinstance(o, rdflib.Literal) else o.safe for o in oo]))
+            entities.append((e.id, e.safe, po))
+
+        return {'format': PICKLE_FORMAT,
+                'g': self.g,
+                'entities': entities,
+                'predicates': list(self.predicates),
+                'inv_predicates': {sp: tep.safe for sp, tep in self.inv_predicates.items()},
+                'inferred': self.inferred,
+                'asserted': self.asserted}
+
+    def __setstate__(self, state):
+        if state['format'] != PICKLE_FORMAT:
+            raise ValueError("Can't unpickle TemplatableGraph format %s, expected %s" % (state['format'], PICKLE_FORMAT))
+
+        self.g = state['g']
+        self.entities = {}
+        self.closures = {}
+        self.generations = {}
+        self.inferred = state['inferred']
+        self.asserted = state['asserted']
+        self.nsIndex = None
+        self.safePathCache = functools.lru_cache(maxsize=SAFE_PATH_CACHE_SIZE)(self.computeSafePath)
+
+        predicates = set(state['predicates'])
+        for s, ss, po in state['entities']:
+            if ss in predicates:
+                self.entities[ss] = TemplatablePredicate(s, ss, self.closures, self.generations)
+            else:
+                self.entities[ss] = TemplatableEntity(s, ss, self.closures, self.generations)
+
+        self.predicates = {sp: self.entities[sp] for sp in state['predicates']}
+        self.inv_predicates = {sp: self.entities[sip] for sp, sip in state['inv_predicates'].items()}
+
+        # Every entry was pickled, inverses and inferences included, and each only once,
+        # so po, op and so can be filled in directly rather than through addLink.
+        for s, ss, po in state['entities']:
+            tes = self.entities[ss]
+            op = {}
+            for ps, oo in po:
+                tep = self.predicates[ps]
+                oo = [o if isinstance(o, rdflib.Literal) else self.entities[o] for o in oo]
+                tes.po[ps] = TemplatableSet(oo)
+                tep.so[ss] = adjacent(oo)
+                for o in oo:
+                    if not isinstance(o, rdflib.Literal):
+                        op.setdefault(o.safe, []).append(tep)
+            for so, pp in op.items():
+                tes.op[so] = adjacent(pp)
+
+        for sp in CLOSURE_PREDICATES:
+            self.computeClosure(sp)
+
+    def computeClosure(self, sp):
+        '''Index e.walk(sp) for every entity e.
+        Each strongly connected component of the sp graph shares a single set, built once
+        from the sets of the components it leads to. Members of a cycle reach each other,
+        including themselves, so cyclic ontologies terminate.'''
+
+        def successors(e):
+            return [o for o in e.po.get(sp, ()) if isinstance(o, TemplatableEntity)]
+
+        closure = {}
+        nodes = [e for e in self.entities.values() if sp in e.po]
+        for component in strongly_connected(nodes, successors):
+            members = set(component)
+            r = TemplatableSet()
+            for e in component:
+                for o in successors(e):
+                    if o in members:
+                        r.update(members) # a cycle
+                    else:
+                        r.add(o)
+                        r.update(closure.get(o.safe, ()))
+            if r:
+                for e in component:
+                    closure[e.safe] = r
+
+        self.closures[sp] = closure
+
+    def entityFor(self, s):
+        '''Return the entity for the node s, creating it if necessary.'''
+        ss = self.safePath(s)
+        tes = self.entities.get(ss)
+        if tes is None:
+            tes = TemplatableEntity(s, ss, self.closures, self.generations)
+            self.entities[ss] = tes
+        return tes
+
+    def predicateFor(self, p, sp):
+        '''Return the predicate for p, creating it if necessary.
+        An entity that has already been seen as a subject or object becomes a predicate in place,
+        so that existing references to it stay valid.'''
+        tep = self.predicates.get(sp)
+        if tep is None:
+            tep = self.entities.get(sp)
+            if tep is None:
+                tep = TemplatablePredicate(p, sp, self.closures, self.generations)
+                self.entities[sp] = tep
+            elif not isinstance(tep, TemplatablePredicate):
+                tep.__class__ = TemplatablePredicate
+                tep.so = {}
+            self.predicates[sp] = tep
+        return tep
+
     def addPredicate(self, p, ip=None):
+        '''Register p as a predicate, with the inverse ip if given, and return it.'''
         sp = self.safePath(p)
 
         if sp in self.predicates:
             if ip is None:
-                return # already know about it
+                return self.predicates[sp] # already know about it
             if self.predicates[sp].id == p and self.inv_predicates.get(sp, None) == ip:
                 logging.debug("Duplicate predicate definition for %s" % p)
-                return
+                return self.predicates[sp]
             if self.predicates[sp].id == ip and self.inv_predicates.get(sp, None) == p:
                 logging.debug("Duplicate predicate definition for %s (inverse)" % p)
-                return
+                return self.predicates[sp]
 
             logging.debug("Re-registering predicate %s with inverse %s (was %s)" % (p, ip, self.inv_predicates.get(sp, None)))
         else:
-            self.predicates[sp] = TemplatablePredicate(p, sp)
-            self.entities[sp] = self.predicates[sp]
+            self.predicateFor(p, sp)
 
             logging.debug("Registering predicate %s with inverse %s" % (p, ip))
 
         if ip is None:
-            return
+            return self.predicates[sp]
 
         sip = self.safePath(ip)
         self.inv_predicates[sip] = self.predicates[sp]
 
         if p != ip:
-            self.predicates[sip] = TemplatablePredicate(ip, sip)
-            self.entities[sip] = self.predicates[sip]
-            self.inv_predicates[sp] = self.predicates[sip]
+            self.inv_predicates[sp] = self.predicateFor(ip, sip)
+
+        return self.predicates[sp]
 
     def addInversePredicates(self):
         for sp, p in list(self.predicates.items()):
@@ -446,6 +891,7 @@ class TemplatableGraph:
                 self.addPredicate(p.id, 'inv_'+p.id)
 
     def wipe(self, s, p):
+        '''Remove every value of p from s, along with anything inferred from them.'''
         ss, sp = self.safePath(s), self.safePath(p)
         if ss not in self.entities:
             raise ValueError("%s: entity does not exist, can't wipe %s" % (s, p))
@@ -453,42 +899,237 @@ class TemplatableGraph:
             raise ValueError("%s: predicate does not exist, can't wipe %s" % (s, p))
 
         tes = self.entities[ss]
-        tep = self.predicates[sp]
-        teip = self.inv_predicates[sp]
+        removed = [(tes.id, p, o if isinstance(o, rdflib.Literal) else o.id) for o in tes.po.get(sp, ())]
+        return self.apply_delta(removed=removed)
 
-        for teo in tes.po[sp]:
-            if not isinstance(teo, rdflib.Literal):
-                # FIXME: haven't tested this
-                tes.op[teo.safe].remove(tep)
-                teo.op[tes.safe].remove(teip)
-                del(teo.po[teip.safe])
-                del(teip.so[teo.safe])
+    def add(self, s, p, o):
+        tes = self.entityFor(s)
+        tep = self.addPredicate(p)
+        if not isinstance(o, rdflib.Literal):
+            o = self.entityFor(o)
+        self.addLink(tes, tep, o)
+
+        if tep.safe in self.closures:
+            self.computeClosure(tep.safe)
+
+    def addLink(self, tes, tep, o, inverse=True):
+        '''Add a triple that is already resolved: tes is an entity, tep a predicate and o an entity or Literal.'''
+        tes.add(tep, o)
+        tep.addso(tes, o)
+
+        if inverse and not isinstance(o, rdflib.Literal):
+            self.addInverse(tes, tep, o)
+
+    def inverseOf(self, tep):
+        teip = self.inv_predicates.get(tep.safe)
+        if teip is None:
+            # a predicate that was first seen after the graph was built
+            self.addPredicate(tep.id, 'inv_'+tep.id)
+            teip = self.inv_predicates[tep.safe]
+        return teip
+
+    def hasDeclaredInverse(self, tep):
+        '''True if tep is symmetric or the declared inverse of another predicate, rather than having an inv_ one made up for it.'''
+        teip = self.inverseOf(tep)
+        return teip.id != 'inv_'+tep.id and tep.id != 'inv_'+teip.id
+
+    def addInverse(self, tes, tep, teo):
+        '''Add the inverse of the triple (tes, tep, teo).'''
+        teip = self.inverseOf(tep)
+        teo.add(teip, tes)
+        teip.addso(teo, tes)
 
-        del(tes.po[sp])
-        del(tep.so[ss])
+    # Incremental changes.
+    # A triple is held as up to two entries, (s, p, o) and, if o is an entity, (o, inverse of p, s).
+    # Where p has a declared inverse, each entry can also come from a triple asserted the other way round,
+    # so self.asserted says which triples were, and an entry stays while either of them is asserted.
+    # Inferred entries are reference counted in self.inferred, so that an entry supported by
+    # several inferences, or also asserted, only goes when nothing supports it any more.
+    # changes, where given, collects the net number of times each entry was added, by entity, so that
+    # an entity that only lost and regained the same entry doesn't count as changed, but one whose value was replaced does.
+
+    def entries(self, tes, tep, o):
+        yield tes, tep, o
+        if not isinstance(o, rdflib.Literal):
+            yield o, self.inverseOf(tep), tes
+
+    def entryKey(self, x, p, y):
+        if isinstance(y, rdflib.Literal):
+            return (x.safe, p.safe, y)
+        return (x.safe, p.safe, y.safe)
+
+    def hasEntry(self, x, p, y):
+        return y in x.po.get(p.safe, ())
+
+    def addEntry(self, x, p, y, changes):
+        x.add(p, y)
+        p.addso(x, y)
+        if changes is not None:
+            k = self.entryKey(x, p, y)
+            changes[x, k] = changes.get((x, k), 0) + 1
+
+    def removeEntry(self, x, p, y, changes):
+        x.remove(p, y)
+        p.removeso(x, y)
+        if changes is not None:
+            k = self.entryKey(x, p, y)
+            changes[x, k] = changes.get((x, k), 0) - 1
+
+    def addInferred(self, tes, tep, o, changes=None):
+        for x, p, y in self.entries(tes, tep, o):
+            k = self.entryKey(x, p, y)
+            if k in self.inferred:
+                self.inferred[k] += 1
+            elif not self.hasEntry(x, p, y):
+                self.inferred[k] = 1
+                self.addEntry(x, p, y, changes)
+            # otherwise it was asserted, and stays regardless
+
+    def retractInferred(self, tes, tep, o, changes=None):
+        for x, p, y in self.entries(tes, tep, o):
+            k = self.entryKey(x, p, y)
+            c = self.inferred.get(k)
+            if c is None:
+                continue # asserted
+            if c > 1:
+                self.inferred[k] = c - 1
+            else:
+                del self.inferred[k]
+                self.removeEntry(x, p, y, changes)
+
+    def assertLink(self, tes, tep, o, changes=None):
+        if not isinstance(o, rdflib.Literal) and self.hasDeclaredInverse(tep):
+            self.asserted.add(self.entryKey(tes, tep, o))
+        for x, p, y in self.entries(tes, tep, o):
+            k = self.entryKey(x, p, y)
+            if k in self.inferred:
+                del self.inferred[k] # no longer depends on inference
+            elif not self.hasEntry(x, p, y):
+                self.addEntry(x, p, y, changes)
+
+    def unassertLink(self, tes, tep, o, changes=None):
+        if not isinstance(o, rdflib.Literal) and self.hasDeclaredInverse(tep):
+            k = self.entryKey(tes, tep, o)
+            if k not in self.asserted:
+                return # only there as the inverse of another triple, or not at all
+            self.asserted.remove(k)
+            teip = self.inverseOf(tep)
+            if (o.safe, teip.safe, tes.safe) in self.asserted:
+                return # still asserted the other way round
+        for x, p, y in self.entries(tes, tep, o):
+            if self.entryKey(x, p, y) not in self.inferred and self.hasEntry(x, p, y):
+                self.removeEntry(x, p, y, changes)
+
+    def infer(self, tes):
+        '''Return the (predicate, object) pairs that tes implies through the property and class hierarchies.
+        Only triples asserted with tes as the subject are used, as when the graph was first built this way;
+        inferred entries would add nothing, as closures are transitive.'''
+        r = []
+        for ps, oo in tes.po.items():
+            tep = self.predicates.get(ps)
+            if ps == 'this' or tep is None:
+                continue
+            supers = tep.walk('rdfs_subPropertyOf')
+            isType = (ps == 'rdf_type')
+            if not supers and not isType:
+                continue
+            declared = self.hasDeclaredInverse(tep)
+            for o in oo:
+                k = self.entryKey(tes, tep, o)
+                if k in self.inferred:
+                    continue # only infer from what was asserted
+                if declared and not isinstance(o, rdflib.Literal) and k not in self.asserted:
+                    continue # the inverse of a triple asserted the other way round
+                for pp in supers:
+                    r.append((pp, o))
+                if isType and isinstance(o, TemplatableEntity):
+                    for tt in o.walk('rdfs_subClassOf'):
+                        r.append((tep, tt))
+
+        # a superproperty might never be used or declared as a property itself
+        return [(pp if isinstance(pp, TemplatablePredicate) else self.addPredicate(pp.id), o) for pp, o in r]
+
+    def resolve(self, s, p, o, create):
+        '''Return the entities for a triple, or None if create is false and any of them is unknown.'''
+        if create:
+            tes = self.entityFor(s)
+            tep = self.addPredicate(p)
+            if not isinstance(o, rdflib.Literal):
+                o = self.entityFor(o)
+            return tes, tep, o
+
+        tes = self.entities.get(self.safePath(s))
+        tep = self.predicates.get(self.safePath(p))
+        if not isinstance(o, rdflib.Literal):
+            o = self.entities.get(self.safePath(o))
+        if tes is None or tep is None or o is None:
+            return None
+        return tes, tep, o
+
+    def apply_delta(self, added=(), removed=()):
+        '''Remove and add triples, and redo only the inferences that depend on them.
+        Returns the set of entities whose properties changed, e.g. so that only their pages need rendering again.'''
+        added = list(added)
+        removed = list(removed)
+
+        for s, p, o in added:
+            # look for statements about predicates
+            if p == OWL['inverseOf'] or (p == RDF['type'] and o == OWL['SymmetricProperty']):
+                ip = s if p == RDF['type'] else o
+                sp = self.safePath(s)
+                if sp in self.inv_predicates and self.inv_predicates[sp].safe != self.safePath(ip):
+                    raise ValueError("%s: can't change the inverse of an existing predicate, rebuild the graph instead" % s)
+
+        removed = [r for r in (self.resolve(s, p, o, False) for s, p, o in removed) if r is not None]
+
+        # Work out whose inferences might change, and what they were, before changing anything.
+        # New entities can't have any inferences yet.
+        if any(tep.safe in CLOSURE_PREDICATES for tes, tep, o in removed) or \
+           any(self.safePath(p) in CLOSURE_PREDICATES for s, p, o in added):
+            # anything could depend on the hierarchy
+            touched = set(self.entities.values())
+        else:
+            touched = set()
+            for tes, tep, o in removed:
+                touched.update(x for x in (tes, o) if isinstance(x, TemplatableEntity))
+            for s, p, o in added:
+                for x in (s, o):
+                    if not isinstance(x, rdflib.Literal) and self.safePath(x) in self.entities:
+                        touched.add(self.entities[self.safePath(x)])
+        previously = {tes: self.infer(tes) for tes in touched}
+
+        changes = {}
+        hierarchy = set()
+
+        for tes, tep, o in removed:
+            self.unassertLink(tes, tep, o, changes)
+            if tep.safe in CLOSURE_PREDICATES:
+                hierarchy.add(tep.safe)
+
+        for s, p, o in added:
+            if p == RDF['type']:
+                if o == OWL['SymmetricProperty']:
+                    self.addPredicate(s, s)
+                elif o == OWL['ObjectProperty'] or o == OWL['DatatypeProperty']:
+                    self.addPredicate(s)
+            elif p == OWL['inverseOf']:
+                self.addPredicate(s, o)
 
-    def add(self, s, p, o):
-        ss, sp = self.safePath(s), self.safePath(p)
-        if ss not in self.entities:
-            self.entities[ss] = TemplatableEntity(s, ss)
-        tes = self.entities[ss]
+            tes, tep, o = self.resolve(s, p, o, True)
+            self.assertLink(tes, tep, o, changes)
+            touched.update(x for x in (tes, o) if isinstance(x, TemplatableEntity))
+            if tep.safe in CLOSURE_PREDICATES:
+                hierarchy.add(tep.safe)
 
-        if sp not in self.predicates:
-            self.predicates[sp] = TemplatablePredicate(p, sp)
-        tep = self.predicates[sp]
-        teip = self.inv_predicates[sp]
+        for sp in hierarchy:
+            self.computeClosure(sp)
 
-        if isinstance(o,rdflib.Literal):
-            tes.add(tep, o)
-            tep.addso(tes, o)
-            return
+        for tes, derived in previously.items():
+            for tep, o in derived:
+                self.retractInferred(tes, tep, o, changes)
 
-        so = self.safePath(o)
-        if so not in self.entities:
-            self.entities[so] = TemplatableEntity(o, so)
-        teo = self.entities[so]
+        for tes in touched:
+            for tep, o in self.infer(tes):
+                self.addInferred(tes, tep, o, changes)
 
-        teo.add(teip, tes)
-        tes.add(tep, teo)
-        tep.addso(tes, teo)
-        teip.addso(teo, tes)
+        return {x for (x, k), n in changes.items() if n}
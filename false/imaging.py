@@ -0,0 +1,114 @@
+#!/usr/bin/python3
+
+import logging, os
+
+# The in-process alternative to running ImageMagick for each image conversion: each image is decoded once,
+# at the smallest scale that is still big enough for every size it's converted to, then all the sizes are made from that.
+# Pillow is only needed if this is used.
+try:
+    import PIL
+    from PIL import Image, ImageOps, JpegImagePlugin
+except ImportError:
+    Image = None
+
+# Bump this whenever the output changes, so that images converted by an older version are converted again
+IMAGING_VERSION = 1
+
+# Geometries are (mode, width, height), with the same meaning as ImageMagick's -resize geometry:
+# "fill" is WxH^ followed by a centred crop to WxH, "shrink" is WxH> (fit inside WxH, never enlarging)
+FILL = "fill"
+SHRINK = "shrink"
+
+# used if the original isn't a JPEG whose quality can be kept, as ImageMagick does
+DEFAULT_JPEG_QUALITY = 92
+
+class NotSupported(Exception):
+    '''The image can't be converted in-process, but might be by ImageMagick.'''
+    pass
+
+def available():
+    return Image is not None
+
+def version():
+    '''Return what decides the output of convert_image, besides the images themselves.'''
+    return f"{IMAGING_VERSION} Pillow {PIL.__version__ if available() else None}"
+
+def scaled_size(size, geometry):
+    '''Return the size that an image of size is resized to for geometry, before any crop, rounded as ImageMagick does.'''
+    mode, width, height = geometry
+    w, h = size
+    if mode == FILL:
+        scale = max(width/w, height/h)
+    elif mode == SHRINK:
+        if w <= width and h <= height:
+            return size
+        scale = min(width/w, height/h)
+    else:
+        raise ValueError(f"Unknown geometry {geometry}")
+    return (max(1, int(w*scale + 0.5)), max(1, int(h*scale + 0.5)))
+
+def resize(img, geometry):
+    '''Return img resized (and cropped) for geometry.'''
+    size = scaled_size(img.size, geometry)
+    if size != img.size:
+        img = img.resize(size, Image.LANCZOS, reducing_gap=3.0)
+
+    mode, width, height = geometry
+    if mode == FILL and img.size != (width, height):
+        # -gravity center -crop WxH+0+0
+        x, y = (img.size[0]-width)//2, (img.size[1]-height)//2
+        img = img.crop((x, y, x+width, y+height))
+    return img
+
+def save_options(src, dest):
+    '''Return the options to save an image converted from src to dest with, keeping what ImageMagick would keep.'''
+    options = {}
+    if src.info.get('icc_profile'):
+        options['icc_profile'] = src.info['icc_profile']
+
+    if os.path.splitext(dest)[1].lower() in ('.jpg', '.jpeg'):
+        if src.format == 'JPEG':
+            # keep the original's quality and chroma subsampling, rather than guessing
+            options['qtables'] = src.quantization
+            sampling = JpegImagePlugin.get_sampling(src)
+            if sampling >= 0:
+                options['subsampling'] = sampling
+        else:
+            options['quality'] = DEFAULT_JPEG_QUALITY
+    return options
+
+def convert_image(src, targets):
+    '''Convert the image file src to each (geometry, dest) in targets, decoding it only once.
+    Like convert -auto-orient, the result is the right way up. Raises NotSupported for animated images.'''
+    if not available():
+        raise NotSupported("Pillow is not installed")
+
+    with Image.open(src) as original:
+        if getattr(original, 'is_animated', False):
+            raise NotSupported(f"{src} is animated")
+
+        # work out the sizes that will be needed the right way up, then ask the decoder for no more than that
+        transposed = original.getexif().get(0x0112, 1) in (5, 6, 7, 8)
+        size = original.size[::-1] if transposed else original.size
+        sizes = [scaled_size(size, geometry) for geometry, dest in targets]
+        need = (max(w for w, h in sizes), max(h for w, h in sizes))
+        original.draft(original.mode, need[::-1] if transposed else need)
+
+        img = ImageOps.exif_transpose(original)
+        if img.mode not in ('RGB', 'RGBA', 'L', 'LA', 'CMYK'):
+            img = img.convert('RGBA' if 'transparency' in img.info or img.mode == 'PA' else 'RGB')
+
+        # biggest first, so that a smaller size is made from a bigger one when that is still twice as big
+        targets = sorted(targets, key=lambda t: scaled_size(size, t[0]), reverse=True)
+        made = []
+        for geometry, dest in targets:
+            base = img
+            for bigger in made:
+                w, h = scaled_size(size, geometry)
+                if bigger.size[0] >= 2*w and bigger.size[1] >= 2*h:
+                    base = bigger
+            out = resize(base, geometry)
+            if geometry[0] == SHRINK:
+                made.append(out)
+            logging.debug(f"{src}: {geometry} -> {dest} {out.size}")
+            out.save(dest, **save_options(original, dest))
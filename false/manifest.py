@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+
+import logging, os, json, hashlib
+
+# Bump this whenever the layout of the manifest changes. An older manifest is then ignored.
+MANIFEST_VERSION = 2
+
+MANIFEST_FILE = "__manifest.json"
+
+def content_hash(blob):
+    return hashlib.sha256(blob).hexdigest()
+
+class Manifest:
+    '''What the builder found and made on its last run, kept in the work dir so that unchanged things can be skipped.
+    files: {path: [size, mtime, hash]}, so that an unchanged file is recognised by stat alone.
+    conversions: {converted path: [source hash, command]}, for each conversion in the work dir.
+    renditions: {rendition dir: [blob hash, info hash, IPFS hash, how]}, for each rendition that has been hashed,
+    where how is "added" if it was added to IPFS, or "hashed" if its hash was only worked out.
+
+    Only what is looked up or recorded during a run is saved, so things that have gone away are forgotten.
+    It is kept in name under the work dir, so that the publisher can keep its own record of the pages it writes.'''
+
+    def __init__(self, work_dir, name=MANIFEST_FILE):
+        self.path = os.path.join(work_dir, name)
+
+        try:
+            m = json.load(open(self.path))
+            if m.get('version') != MANIFEST_VERSION:
+                raise ValueError(f"version {m.get('version')}, expected {MANIFEST_VERSION}")
+        except FileNotFoundError:
+            logging.info(f"No manifest at {self.path}, everything will be rebuilt")
+            m = {}
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring manifest {self.path}: {e}")
+            m = {}
+
+        self.old = {k: m.get(k, {}) for k in ('files', 'conversions', 'renditions')}
+        self.new = {k: {} for k in self.old}
+
+    def _get(self, k, key):
+        v = self.old[k].get(key)
+        if v is not None:
+            self.new[k][key] = v
+        return v
+
+    def file_hash(self, fn):
+        '''Return the content hash of fn, only reading it if its size or mtime has changed since it was last hashed.'''
+        st = os.stat(fn)
+        e = self._get('files', fn)
+        if e and e[0] == st.st_size and e[1] == st.st_mtime_ns:
+            return e[2]
+
+        h = hashlib.sha256()
+        with open(fn, "rb") as f:
+            for chunk in iter(lambda: f.read(1<<20), b""):
+                h.update(chunk)
+        self.wrote(fn, h.hexdigest())
+        return h.hexdigest()
+
+    def wrote(self, fn, h):
+        '''Record that fn, which has just been written, has the content hash h.'''
+        st = os.stat(fn)
+        self.new['files'][fn] = self.old['files'][fn] = [st.st_size, st.st_mtime_ns, h]
+
+    def is_converted(self, dest, src_hash, command):
+        '''True if dest was converted by command from a source with the content hash src_hash.'''
+        return self._get('conversions', dest) == [src_hash, command] and os.path.exists(dest)
+
+    def converted(self, dest, src_hash, command):
+        self.new['conversions'][dest] = self.old['conversions'][dest] = [src_hash, command]
+
+    def rendition_hash(self, entity_dir, blob_hash, info_hash, ipfs_add=False):
+        '''Return the IPFS hash of the rendition in entity_dir, if its blob and info are unchanged, otherwise None.
+        With ipfs_add, a hash that was only worked out doesn't count, as the rendition still has to be added to IPFS.'''
+        e = self._get('renditions', entity_dir)
+        if e and e[0] == blob_hash and e[1] == info_hash and (e[3] == "added" or not ipfs_add):
+            return e[2]
+
+    def added_rendition(self, entity_dir, blob_hash, info_hash, ipfs_hash, added):
+        '''Record the IPFS hash of the rendition in entity_dir, and whether it was added to IPFS or only hashed.'''
+        how = "added" if added else "hashed"
+        self.new['renditions'][entity_dir] = self.old['renditions'][entity_dir] = [blob_hash, info_hash, ipfs_hash, how]
+
+    def save(self):
+        m = dict(self.new)
+        m['version'] = MANIFEST_VERSION
+
+        tmp = self.path+".tmp"
+        with open(tmp, "w") as f:
+            json.dump(m, f)
+        os.replace(tmp, self.path)
@@ -1,10 +1,14 @@
 #!/usr/bin/python3
 
-import markdown, re, logging, urllib, rdflib, html
+import markdown, re, logging, urllib, rdflib, html, copy
 import xml.etree.ElementTree as etree
 
 F = rdflib.Namespace("http://id.colourcountry.net/false/")
 
+# The extensions that change how markdown is parsed for each page file type, as opposed to what is done with the parse.
+# The builder parses like html pages, so they share a parse in the MarkdownCache.
+PARSE_EXTENSIONS = {'html': ['tables'], 'gmi': []}
+
 class UnescapePostprocessor(markdown.postprocessors.Postprocessor):
     def run(self, s):
         return html.unescape(s)
@@ -93,12 +97,15 @@ class ImgRewriter(markdown.treeprocessors.Treeprocessor):
         super(ImgRewriter, self).__init__(md)
 
     def run(self, doc):
+        # what was looked up in the graph, so that CachedMarkdown can tell if the output would still be the same
+        self.md.entity_checks = []
 
         for parent in doc.findall('.//img/..'):
             for image in parent.findall('.//img'):
                 src = image.get('src')
                 src = urllib.parse.urljoin(self.base, src)
                 src_safe = self.tg.safePath(src)
+                self.md.entity_checks.append((src_safe, src_safe in self.tg.entities))
                 if src_safe in self.tg.entities:
                     logging.debug("Found image with src {src}".format(src=src))
                     image.set('src', src)
@@ -114,6 +121,7 @@ class ImgRewriter(markdown.treeprocessors.Treeprocessor):
                 href = urllib.parse.urljoin(self.base, href)
 
                 href_safe = self.tg.safePath(href)
+                self.md.entity_checks.append((href_safe, href_safe in self.tg.entities))
                 if href_safe in self.tg.entities:
                     logging.debug("Found link with href {href}".format(href=href))
                     link.set('src', href)
@@ -144,9 +152,85 @@ class GeminiExtension(ImgRewriteExtension):
         md.postprocessors.register(UnescapePostprocessor(md), 'unescape', 0)
 
 
-def get_markdown_processor(tg,cfg):
+class SkipParsing(markdown.preprocessors.Preprocessor):
+    '''Leaves nothing to parse when md.parse already holds the parse.'''
+    def run(self, lines):
+        return lines if self.md.parse is None else []
+
+class KeepParse(markdown.treeprocessors.Treeprocessor):
+    '''Runs after markdown's own tree processors, before FALSE's look anything up in the graph.
+    Keeps a copy of the tree and the raw HTML stashed outside it in md.parse, or carries on from md.parse if it was given.'''
+    def run(self, doc):
+        if self.md.parse is None:
+            self.md.parse = (copy.deepcopy(doc), list(self.md.htmlStash.rawHtmlBlocks))
+            return None
+
+        doc, blocks = self.md.parse
+        self.md.htmlStash.rawHtmlBlocks = blocks
+        self.md.htmlStash.html_counter = len(blocks)
+        return doc
+
+class KeepParseExtension(markdown.extensions.Extension):
+    def extendMarkdown(self, md, md_globals=None):
+        md.parse = None
+        md.preprocessors.register(SkipParsing(md), 'skipparsing', 100)
+        md.treeprocessors.register(KeepParse(md), 'keepparse', 5)
+
+def parse_key(cache, page_file_type, text):
+    return cache.key('parse', ' '.join(PARSE_EXTENSIONS[page_file_type]), text)
+
+def parse_markdown(text, cache, page_file_type='html'):
+    '''Return the tree that text is parsed into for page_file_type, from cache (a MarkdownCache) if it has been parsed before.'''
+    key = parse_key(cache, page_file_type, text)
+    parse = cache.get(key)
+    if parse is None:
+        md = markdown.Markdown(extensions=[KeepParseExtension()] + PARSE_EXTENSIONS[page_file_type])
+        md.convert(text)
+        parse = md.parse or (etree.Element(md.doc_tag), []) # blank text isn't parsed at all
+        cache.put(key, parse)
+    return parse[0]
+
+class CachedMarkdown:
+    '''A markdown processor whose output is kept in a MarkdownCache, which also keeps its parse, shared with the builder.
+    The output depends on which of the entities it refers to are in the graph, so it is only reused if that hasn't changed.
+    md needs the KeepParseExtension.'''
+    def __init__(self, md, tg, page_file_type, config, cache):
+        self.md = md
+        self.tg = tg
+        self.page_file_type = page_file_type
+        self.config = config
+        self.cache = cache
+
+    def convert(self, text):
+        key = self.cache.key('page', self.config, text)
+        cached = self.cache.get(key)
+        if cached is not None:
+            html, checks = cached
+            if all((safe in self.tg.entities) == found for safe, found in checks):
+                return html
+
+        pkey = parse_key(self.cache, self.page_file_type, text)
+        self.md.reset()
+        self.md.parse = parsed = self.cache.get(pkey)
+        try:
+            html = self.md.convert(text)
+            if parsed is None and self.md.parse is not None:
+                self.cache.put(pkey, self.md.parse)
+        finally:
+            self.md.parse = None
+
+        self.cache.put(key, (html, self.md.entity_checks))
+        return html
+
+def get_markdown_processor(tg,cfg,cache=None):
+    extensions = [] if cache is None else [KeepParseExtension()]
     if cfg.page_file_type=='html':
-        return markdown.Markdown(output_format="html5", extensions=[ImgRewriteExtension(tg=tg, base=cfg.id_base), 'tables'])
+        md = markdown.Markdown(output_format="html5", extensions=extensions+[ImgRewriteExtension(tg=tg, base=cfg.id_base)]+PARSE_EXTENSIONS['html'])
     elif cfg.page_file_type=='gmi':
-        return markdown.Markdown(output_format="xhtml", extensions=[GeminiExtension(tg=tg, base=cfg.id_base)])
-    raise ValueError(f"No markdown processor available for {cfg.page_file_type}")
+        md = markdown.Markdown(output_format="xhtml", extensions=extensions+[GeminiExtension(tg=tg, base=cfg.id_base)]+PARSE_EXTENSIONS['gmi'])
+    else:
+        raise ValueError(f"No markdown processor available for {cfg.page_file_type}")
+
+    if cache is None:
+        return md
+    return CachedMarkdown(md, tg, cfg.page_file_type, f"{cfg.page_file_type} {cfg.id_base}", cache)
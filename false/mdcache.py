@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+
+import logging, os, hashlib, pickle, collections, markdown
+
+# Bump this whenever what is cached changes, including the output of FALSE's markdown extensions
+MARKDOWN_CACHE_VERSION = 2
+
+# Entries are kept in this directory under the work dir
+MARKDOWN_CACHE_DIR = "__markdown"
+
+# Touched when a build starts, see mark() and prune()
+MARKDOWN_CACHE_MARK = "started"
+
+# How much of the cache to keep in memory, in bytes of pickled entries
+MARKDOWN_MEMO_SIZE = 64 << 20
+
+class MarkdownCache:
+    '''What markdown was converted to, shared by the builder and the publisher, and kept in the work dir between runs.
+    Entries are addressed by a hash of the markdown and of how it was converted, so an entry never goes out of date,
+    though what is kept in it may need checking before it is used. Without a work_dir, entries are only kept in memory.
+    Entries are kept pickled, so each get returns a new copy that the caller is free to change.
+    Once the entries in memory add up to more than size bytes, the least recently used are forgotten, and read back
+    from the work dir if they are needed again. Reading an entry back touches its file, so that prune() keeps it.'''
+
+    def __init__(self, work_dir=None, size=MARKDOWN_MEMO_SIZE):
+        self.dir = work_dir and os.path.join(work_dir, MARKDOWN_CACHE_DIR)
+        self.size = size
+        self.used = 0
+        self.memo = collections.OrderedDict() # key: pickled entry, least recently used first
+
+    def key(self, kind, config, text):
+        '''Return the key for text converted for kind (such as "parse" or "page") with config, which must be a string.'''
+        h = hashlib.sha256(f"{MARKDOWN_CACHE_VERSION} {markdown.__version__} {kind} {config}\n".encode("utf-8"))
+        h.update(text.encode("utf-8"))
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.dir, key[:2], key+".pickle")
+
+    def _remember(self, key, data):
+        old = self.memo.pop(key, None)
+        if old is not None:
+            self.used -= len(old)
+        if len(data) > self.size:
+            return
+        self.memo[key] = data
+        self.used += len(data)
+        while self.used > self.size:
+            k, d = self.memo.popitem(last=False)
+            self.used -= len(d)
+
+    def get(self, key):
+        '''Return what was put under key, or None.'''
+        data = self.memo.get(key)
+        if data is not None:
+            self.memo.move_to_end(key)
+        elif not self.dir:
+            return None
+        else:
+            fn = self._path(key)
+            try:
+                with open(fn, "rb") as f:
+                    data = f.read()
+                os.utime(fn)
+            except FileNotFoundError:
+                return None
+
+        try:
+            value = pickle.loads(data)
+        except Exception as e:
+            logging.warning(f"Ignoring cached markdown {key}: {e}")
+            return None
+
+        self._remember(key, data)
+        return value
+
+    def put(self, key, value):
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        self._remember(key, data)
+        if not self.dir:
+            return
+
+        fn = self._path(key)
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        with open(f"{fn}.{os.getpid()}.tmp", "wb") as f:
+            f.write(data)
+        os.replace(f"{fn}.{os.getpid()}.tmp", fn)
+
+def mark(work_dir):
+    '''Note that a build is starting, and return the time to prune() the cache in work_dir by when it has finished.'''
+    fn = os.path.join(work_dir, MARKDOWN_CACHE_DIR, MARKDOWN_CACHE_MARK)
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    with open(fn, "w"):
+        pass
+    # the file system's clock, which the entries' times come from too
+    return os.stat(fn).st_mtime_ns
+
+def prune(work_dir, since):
+    '''Remove the entries in work_dir's cache that haven't been read or written since the time since, from mark().
+    A build and the publishing after it use every entry they need, so the rest are for markdown that has gone or changed.'''
+    d = os.path.join(work_dir, MARKDOWN_CACHE_DIR)
+    n = 0
+    for path, dirs, files in os.walk(d):
+        for f in files:
+            fn = os.path.join(path, f)
+            if fn.endswith(".pickle") and os.stat(fn).st_mtime_ns < since:
+                os.remove(fn)
+                n += 1
+    logging.info(f"Removed {n} unused entries from the markdown cache")
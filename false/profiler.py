@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+
+import collections
+
+from false.graph import TemplatableEntity
+
+class AttributeProfiler:
+    '''Counts attribute lookups on entities and sets, per (template, type, attribute).
+    Install it with false.graph.set_profiler(). When no profiler is installed, lookups are not counted at all.
+
+    Lookups on a set are counted under the type "set". When a set has to project an attribute
+    (rather than reusing a remembered projection), the lookups on its members are counted too, under their own types.'''
+
+    def __init__(self):
+        self.template = None # set by the publisher while it renders
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+
+    def count(self, obj, a, result):
+        if isinstance(obj, TemplatableEntity):
+            t = ' '.join(sorted(x.safe for x in obj.type())) or '-'
+        else:
+            t = 'set'
+
+        k = (self.template or '-', t, a)
+        if result:
+            self.hits[k] += 1
+        else:
+            self.misses[k] += 1
+
+    def report(self, n=20):
+        '''Return a text summary of the n hottest and n most-missed lookups.'''
+        def table(title, counter):
+            lines = [title, '%10s %10s  %s' % ('hits', 'misses', 'template / type / attribute')]
+            for k, c in counter.most_common(n):
+                lines.append('%10d %10d  %s / %s / %s' % (self.hits[k], self.misses[k], k[0], k[1], k[2]))
+            return lines
+
+        lines = table('Hottest attribute lookups:', self.hits + self.misses)
+        lines.append('')
+        lines += table('Most missed attribute lookups:', self.misses)
+        return '\n'.join(lines)
+
+class DependencyRecorder:
+    '''Records the safe names of the entities that attribute lookups are made on, and that they return, in reads.
+    Whatever a lookup returns counts too, as a template can go on to use it without further lookups, e.g. to sort by it.
+    Install it with false.graph.set_profiler(). Lookups are passed on to inner, another profiler, if there is one.'''
+
+    def __init__(self, inner=None):
+        self.inner = inner
+        self.reads = set()
+
+    @property
+    def template(self):
+        return self.inner and self.inner.template
+
+    @template.setter
+    def template(self, t):
+        if self.inner is not None:
+            self.inner.template = t
+
+    def count(self, obj, a, result):
+        if isinstance(obj, TemplatableEntity):
+            self.reads.add(obj.safe)
+        else:
+            self.reads.update(x.safe for x in obj if isinstance(x, TemplatableEntity))
+
+        if isinstance(result, set):
+            self.reads.update(x.safe for x in result if isinstance(x, TemplatableEntity))
+
+        if self.inner is not None:
+            self.inner.count(obj, a, result)
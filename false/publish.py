@@ -1,11 +1,16 @@
 #!/usr/bin/python3
 
 import rdflib
-import sys, logging, os, re, urllib.parse, shutil, datetime, subprocess
+import sys, logging, os, re, urllib.parse, shutil, datetime, subprocess, concurrent.futures, multiprocessing
 import jinja2, pprint, traceback
 
+import false.graph, false.profiler
 from false.graph import *
 from false.markdown import *
+from false.mdcache import MarkdownCache
+from false.fragments import FragmentStore
+from false.manifest import Manifest, content_hash
+from false.references import CONTENT_REFERENCES, scan_content_references, substitute_content_references
 
 EXTERNAL_LINKS = {
   "http://www.wikidata.org/wiki/\\1": re.compile("http://www.wikidata.org/entity/(.*)")
@@ -15,6 +20,19 @@ F = rdflib.Namespace("http://id.colourcountry.net/false/")
 TEMP_IPFS = rdflib.Namespace("ipfs:/") # our temporary URI scheme
 TRUE_IPFS = rdflib.Namespace("/ipfs/")
 
+# Rendering is only shared between processes if each would get at least this many pages, as forking costs more than a few pages
+MIN_ITEMS_PER_PROCESS = 50
+
+# The sizes, mtimes and hashes of the pages that have been written are kept in this file under the work dir
+PAGE_MANIFEST_FILE = "__pages.json"
+
+# (function, items) for the processes that Publisher.map forks, set just before they are
+_forked = None
+
+def _call_forked(i):
+    fn, items = _forked
+    return fn(items[i])
+
 # TODO: put this per-context configuration into the graph
 # note: "HTML" just means the output file format, FALSE doesn't care if it's HTML or not.
 HTML_FOR_CONTEXT = { F.link: F.linkHTML, F.teaser: F.teaserHTML, F.embed: F.embedHTML, F.page: F.pageHTML }
@@ -58,18 +76,16 @@ def get_page_path(e_safe, ctx_safe, e_type, output_dir, file_type='html'):
 def get_page_url(e_safe, ctx_safe, e_type, url_base, file_type='html'):
     return "/".join([url_base]+_get_page_tree(e_safe,ctx_safe,e_type,file_type))
 
-def resolve_content_reference(m, tg, base, stage, e, upgrade_to_teaser=False):
-    logging.debug("Resolving content reference {ref}".format(ref=m.group(1)))
-
+def parse_content_reference(tag_attrs, tg, base, upgrade_to_teaser=False):
+    '''Return the ID, safe name and context of the page that a false-content tag with the attributes tag_attrs refers to.'''
     attrs = {}
-    for mm in re.finditer('(\S+)="([^"]*)"', m.group(1)):
+    for mm in re.finditer('(\S+)="([^"]*)"', tag_attrs):
         attrs[mm.group(1)]=mm.group(2)
 
     if attrs["src"].startswith("_:"): # don't resolve blank nodes
         src = attrs["src"]
     else:
         src = urllib.parse.urljoin(base, attrs["src"])
-    src_safe = tg.safePath(src)
 
     if "context" in attrs:
         ctx = rdflib.URIRef(attrs["context"])
@@ -78,6 +94,63 @@ def resolve_content_reference(m, tg, base, stage, e, upgrade_to_teaser=False):
     else:
         ctx = F.teaser
 
+    return src, tg.safePath(src), ctx
+
+def find_content_references(scanned, tg, base):
+    '''Return the (safe name, context) of each page that some content includes, given what scan_content_references found in it.'''
+    tags = {(attrs, CONTENT_REFERENCES[k][1]) for start, end, k, attrs in scanned}
+    return {parse_content_reference(tag_attrs, tg, base, upgrade)[1:] for tag_attrs, upgrade in tags}
+
+def order_by_requirements(requires):
+    '''Order the items of requires, which maps each item to the items that must come before it, so that they do.
+    Requirements that aren't items of requires are left out. Returns the ordered items, and the cycles in the rest,
+    each as a list that starts and ends with the same item. The items that are left out of both need one of the cycles.'''
+    needed_by = {}
+    waiting = {}
+    for item, rr in requires.items():
+        rr = [r for r in rr if r in requires]
+        waiting[item] = len(rr)
+        for r in rr:
+            needed_by.setdefault(r, []).append(item)
+
+    ready = [item for item, n in waiting.items() if not n]
+    order = []
+    while ready:
+        item = ready.pop()
+        order.append(item)
+        for x in needed_by.get(item, ()):
+            waiting[x] -= 1
+            if not waiting[x]:
+                ready.append(x)
+
+    # everything left over needs something else that is left over, so following those leads round a cycle
+    cycles = []
+    seen = set()
+    for item, n in waiting.items():
+        path = {}
+        while n and item not in seen:
+            seen.add(item)
+            path[item] = len(path)
+            item = next(r for r in requires[item] if waiting.get(r))
+            n = waiting[item]
+        if item in path:
+            cycle = list(path)[path[item]:]
+            cycles.append(cycle + cycle[:1])
+
+    return order, cycles
+
+def resolve_content_reference(tag_attrs, tg, base, stage, e, upgrade_to_teaser=False, pending=(), requires=None, fragments=None):
+    '''Return the page that a false-content tag with the attributes tag_attrs refers to, for inclusion in the page of e.
+    A page in pending is about to be rendered again, so isn't ready.
+    requires, if given, collects the (safe name, context) of the page, whether or not it can be found.
+    fragments, if given, is a FragmentStore to look for the page in before reading its file.'''
+    logging.debug("Resolving content reference {ref}".format(ref=tag_attrs))
+
+    src, src_safe, ctx = parse_content_reference(tag_attrs, tg, base, upgrade_to_teaser)
+
+    if requires is not None:
+        requires.add((src_safe, ctx))
+
     if src_safe not in tg.entities:
         r = "can't resolve {src}@@{ctx}: not in universe".format(src=src,ctx=ctx)
         logging.warning(r)
@@ -92,9 +165,15 @@ def resolve_content_reference(m, tg, base, stage, e, upgrade_to_teaser=False):
         logging.warning(r)
         return ""
 
+    if (tg.entities[src_safe], ctx) in pending:
+        raise PublishNotReadyError("requires {src}@@{ctx}, which is changing".format(src=src,ctx=ctx))
+
     # the stage has (template, path) for each context so [1] references the path
-    fn = stage[(tg.entities[src_safe],ctx)][1]
+    item = (tg.entities[src_safe],ctx)
+    fn = stage[item][1]
     try:
+        if fragments is not None:
+            return fragments.get(item, fn)
         with open(fn,'r') as f:
             return f.read()
     except FileNotFoundError:
@@ -181,10 +260,8 @@ def get_html_body(tg, e, ctx, markdown_processor, cache_dir):
     logging.debug(f"{e.id}@@{ctx.id}: no suitable rendition")
     return ""
 
-def publish_graph(g, cfg):
-
-    # Fix up everywhere there is an IPFS uri
-
+def fix_ipfs_uris(g):
+    '''Turn the builder's temporary IPFS URIs in g into real ones.'''
     count = 0
     for s,p,o in g.triples((None, None, None)):
         new_s = None
@@ -199,31 +276,149 @@ def publish_graph(g, cfg):
             g.add((new_s or s, p, new_o or o))
     logging.info(f"Fixed up {count} IPFS URLs")
 
-    tg = TemplatableGraph(g)
-
-    def get_time_now():
-        return datetime.datetime.utcnow().isoformat()
-
-    jinja_e = jinja2.Environment(
-        loader=jinja2.FileSystemLoader(cfg.template_dir),
-        autoescape=cfg.html_escape,
-        trim_blocks=True,
-        lstrip_blocks=True
-    )
-    jinja_e.globals["now"] = get_time_now
+def prepare_graph(g):
+    '''Fix up the IPFS URIs in g and return its TemplatableGraph, ready for publish_graph.'''
+    fix_ipfs_uris(g)
+    return TemplatableGraph(g)
+
+class TemplateResolver:
+    '''Finds the template for an entity in a context, by walking up from its most specific types until one has a template.
+    The answer only depends on the context and those types, so it is worked out once for each combination of them,
+    and forgotten when the class hierarchy changes. With prescan, the templates that exist are listed once,
+    so that the types without one don't have to be looked for in the template dir.'''
+
+    def __init__(self, tg, jinja_e, prescan=True):
+        self.tg = tg
+        self.jinja_e = jinja_e
+        self.prescan = prescan
+        self.clear()
+
+    def clear(self):
+        '''Forget everything, for when the templates have changed.'''
+        self.resolved = {} # (context, safe names of types): (template, type) or None
+        self.hierarchy = self.tg.closures.get('rdfs_subClassOf')
+        self.names = None
+        if self.prescan:
+            try:
+                self.names = set(self.jinja_e.list_templates())
+            except TypeError:
+                logging.debug("Template loader can't list templates, looking for each one instead")
 
-    markdown_processor = get_markdown_processor(tg,cfg)
+    def get_template(self, t_path):
+        if self.names is not None and t_path not in self.names:
+            return None
+        try:
+            return self.jinja_e.get_template(t_path)
+        except jinja2.exceptions.TemplateNotFound:
+            return None
+
+    def resolve(self, ctx_safe, e_types):
+        '''Return (template, type) for an entity whose most specific types are e_types, in the context ctx_safe,
+        or None if none of its types has a template.'''
+        if self.tg.closures.get('rdfs_subClassOf') is not self.hierarchy:
+            self.resolved = {}
+            self.hierarchy = self.tg.closures.get('rdfs_subClassOf')
+
+        key = (ctx_safe, frozenset(t.safe for t in e_types))
+        if key in self.resolved:
+            return self.resolved[key]
+
+        r = None
+        while e_types and r is None:
+            for e_type in e_types:
+                t_path = os.path.join(ctx_safe, e_type.safe)
+                tpl = self.get_template(t_path)
+                if tpl is None:
+                    logging.debug("no template at {path}".format(path=t_path))
+                    continue
+                r = (tpl, e_type) # found a renderable type
+                break
+            else:
+                # get the next layer of types
+                e_types = e_types.get('rdfs_subClassOf')
+                logging.debug("{ctx}: no template for {key}, trying {types}".format(ctx=ctx_safe, key=sorted(key[1]), types=repr(e_types)))
+
+        self.resolved[key] = r
+        return r
+
+def publish_graph(g, cfg, tg=None, jobs=None):
+    '''Render every page of g, with up to jobs processes (default: one per CPU). tg, if given, must have come from prepare_graph(g).'''
+    if tg is None:
+        tg = prepare_graph(g)
+    return Publisher(tg, cfg, jobs=jobs).publish()
+
+class Publisher:
+    '''Renders the pages of the entities in a TemplatableGraph.
+    With watch set, it remembers what each page looked at in the graph and which other pages it included,
+    so that when the graph or the templates change, update() only renders the pages that might be different.
+    Inner HTML and templates are rendered by up to jobs processes at once (default: one per CPU).'''
+
+    def __init__(self, tg, cfg, watch=False, prescan_templates=True, jobs=None):
+        self.tg = tg
+        self.cfg = cfg
+        self.jobs = jobs or os.cpu_count() or 1
+
+        def get_time_now():
+            return datetime.datetime.utcnow().isoformat()
+
+        self.jinja_e = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(cfg.template_dir),
+            autoescape=cfg.html_escape,
+            trim_blocks=True,
+            lstrip_blocks=True
+        )
+        self.jinja_e.globals["now"] = get_time_now
+
+        # entities of the same types use the same templates
+        self.templates = TemplateResolver(tg, self.jinja_e, prescan_templates)
+
+        # the same markdown is converted for each context it is used in, and again on every run
+        self.markdown_processor = get_markdown_processor(tg,cfg,MarkdownCache(cfg.work_dir))
+
+        self.cache_dir = os.path.join(cfg.output_dir, "ipfs")
+        self.stage = {} # (entity, context): (template, destination)
+        self.added = {} # entity: URLs that staging added to it
+        self.bodies = {} # (entity, context): the inner HTML added to the entity
+        self.home_page = None
+        self.index_page = None # the home page that index.html leads to
+
+        # what has been written, for the pages that include it
+        self.fragments = FragmentStore()
+
+        # what has been written, so that unchanged pages are recognised without reading them back
+        self.pages = Manifest(cfg.work_dir, PAGE_MANIFEST_FILE)
+
+        # (entity, context): (safe names of the entities it looked at, (safe name, context) of the pages it included)
+        self.deps = {} if watch else None
+        self.recorder = None # records what is looked at, while rendering with deps
+
+        # what couldn't be rendered last time
+        self.unfinished = set()
+
+    def publish(self):
+        '''Render every page, and return the URL of the home page.'''
+        for e_safe, e in self.tg.entities.items():
+            self.stage_entity(e_safe, e)
+
+        logging.info("Stage is ready: {n} destinations, {m} entities".format(n=len(self.stage), m=len(set(e for e, ctx in self.stage))))
+
+        if not self.home_page:
+            raise PublishError("Home page {home} is not staged, can't continue".format(home=self.cfg.home_site))
+
+        self.render(self.stage.keys())
+        self.fragments.report()
+        self.pages.save()
+        self.write_index()
+        return self.home_page
+
+    def stage_entity(self, e_safe, e):
+        '''Find the template and destination of each page of e.'''
+        tg, cfg, stage = self.tg, self.cfg, self.stage
 
-    embed_html = {}
-    entities_to_write = set()
-    stage = {}
-    home_page = None
-    cache_dir = os.path.join(cfg.output_dir, "ipfs")
-    for e_safe, e in tg.entities.items():
         allTypes = e.get('rdf_type')
         if not allTypes:
             logging.debug("{e}: unknown type? {debug}".format(e=e.id, debug=e.debug()))
-            continue
+            return
 
         if F.WebPage in allTypes:
             if hasattr(e, 'url'):
@@ -233,6 +428,7 @@ def publish_graph(g, cfg):
                 if e.isBlankNode():
                     raise PublishError("{e}: WebPage which is a blank node must have a :url property.".format(e=e.id))
                 tg.add(e.id, F.url, rdflib.Literal(e.id))
+                self.added.setdefault(e, []).append(rdflib.Literal(e.id))
 
         for ctx_id in HTML_FOR_CONTEXT:
             ctx_safe = tg.safePath(ctx_id)
@@ -246,129 +442,331 @@ def publish_graph(g, cfg):
 
             # use the most direct type because we need to go up in a specific order
             # TODO: provide ordered walk functions on entities?
-            e_types = e.type()
-
-            dest = None
-
-            while e_types:
-                for e_type in e_types:
-                    t_path = os.path.join(ctx_safe, e_type.safe)
-                    try:
-                        tpl = jinja_e.get_template(t_path)
-                    except jinja2.exceptions.TemplateNotFound as err:
-                        logging.debug("{e}: no template at {path}".format(e=e.id, path=t_path))
-                        continue
-
-                    dest = get_page_path(e_safe, ctx_safe, e_type, cfg.page_output_dir, cfg.page_file_type)
-                    url = get_page_url(e_safe, ctx_safe, e_type, cfg.url_base, cfg.page_file_type)
-                    e_types = None # found a renderable type
-                    break
-
-                if e_types is not None:
-                    # get the next layer of types
-                    e_types = e_types.get('rdfs_subClassOf')
-                    logging.debug("{e}@@{ctx}: no template for direct type, trying {types}".format(e=e.id, ctx=ctx_id, types=repr(e_types)))
-
-            if dest is None:
+            resolved = self.templates.resolve(ctx_safe, e.type())
+            if resolved is None:
                 logging.debug("{e}@@{ctx}: no template available".format(e=e.id, ctx=ctx_id))
                 continue
 
+            tpl, e_type = resolved
+            dest = get_page_path(e_safe, ctx_safe, e_type, cfg.page_output_dir, cfg.page_file_type)
+            url = get_page_url(e_safe, ctx_safe, e_type, cfg.url_base, cfg.page_file_type)
+
             logging.debug(f'{e.id}@@{ctx_id}: will render as {e_type.id} -> {dest} ({url})')
             stage[(e, ctx_id)]=(tpl, dest)
 
-            entities_to_write.add(e)
             if url in e:
               logging.debug(f"wtf using existing url {e.url}")
 
             if ctx_id == F.page and 'url' not in e:
                 # add the computed URL of the item as a full page, for templates to pick up
                 tg.add(e.id, F.url, rdflib.Literal(url))
+                self.added.setdefault(e, []).append(rdflib.Literal(url))
 
             if e.id == rdflib.URIRef(cfg.home_site):
-                home_page = url
+                self.home_page = url
 
+    def unstage_entity(self, e):
+        '''Forget the pages of e, and the URLs that staging added to it.'''
+        for ctx_id in HTML_FOR_CONTEXT:
+            self.stage.pop((e, ctx_id), None)
 
-    logging.info("Stage is ready: {n} destinations, {m} entities".format(n=len(stage), m=len(entities_to_write)))
-
-    if not home_page:
-        raise PublishError("Home page {home} is not staged, can't continue".format(home=cfg.home_site))
+        added = self.added.pop(e, [])
+        if added:
+            self.tg.apply_delta(removed=[(e.id, F.url, url) for url in added])
 
-    iteration = 0
-    to_write = set(stage.keys())
-    progress = True
-    while progress:
-        iteration += 1
-        progress = False
-        logging.info("Publish iteration {i}: {n} of {m} destinations left".format(i=iteration, n=len(to_write), m=len(stage)))
-        next_write = {}
+        if e.id == rdflib.URIRef(self.cfg.home_site):
+            self.home_page = None
 
-        # now build the HTML for everything in the different contexts and add to the graph
-        for item in to_write:
-            item = item[:2]
-            e, ctx_id = item
-            tpl, dest = stage[item]
-            htmlProperty = HTML_FOR_CONTEXT[ctx_id]
+    def render(self, items):
+        '''Render the pages for items, which are (entity, context) keys of the stage, each exactly once.
+        The inner HTML of all of them is added to the graph first, so that any template can use any of it.
+        Then the templates are rendered, and last the pages they include are put in,
+        in an order where each page comes after the ones it includes.
+        Inner HTML and templates are rendered by map, so possibly in other processes, but only this one changes the graph.
+        Returns the safe names of the entities whose inner HTML changed, and the items whose pages changed.'''
+        tg = self.tg
+        items = [item[:2] for item in items]
 
-            if htmlProperty in e:
-                raise PublishError("{e}: already have inner html for {ctx}".format(e=e.id, ctx=ctx_id))
-                continue
+        # pages that will be rendered again can't be included as they are
+        pending = set(items) if self.deps is not None else ()
 
-            ctx_safe = tg.safePath(ctx_id)
-            body = get_html_body(tg, e, tg.entities[ctx_safe], markdown_processor, cache_dir)
+        bodies_changed = set()
+        pages_changed = set()
+        failed = {} # item: (error, traceback)
 
-            # Add the inner (markdown-derived) html to the graph for templates to pick up
-            logging.debug(f"Adding this inner html as {htmlProperty} to {e.id}@@{ctx_id}:\n{body[:100]}...")
-            tg.add(e.id, htmlProperty, rdflib.Literal(body))
+        if self.deps is not None:
+            self.recorder = false.profiler.DependencyRecorder(false.graph.profiler)
+            false.graph.set_profiler(self.recorder)
 
-            try:
-                content = e.render(tpl)
-            except (jinja2.exceptions.UndefinedError, RequiredAttributeError) as err:
-                # If an attribute is missing it may be a body for another entity/context that is not yet rendered
-                logging.debug(f"{e.id}@@{ctx_id} not ready for {tpl}: {err}\nEntity is: {e.debug()}")
-                next_write[(e, ctx_id)] = (err, traceback.format_exc())
+        try:
+            for item in items:
+                e, ctx_id = item
+                if HTML_FOR_CONTEXT[ctx_id] in e:
+                    raise PublishError("{e}: already have inner html for {ctx}".format(e=e.id, ctx=ctx_id))
+
+                if self.recorder is not None:
+                    # a template can look at anything the entity refers to without looking it up
+                    reads = {e.safe}
+                    for a, oo in e.po.items():
+                        if a != 'this':
+                            reads.update(o.safe for o in oo if isinstance(o, TemplatableEntity))
+                    self.deps[item] = (reads, set())
+
+            # build the HTML for everything in the different contexts and add to the graph
+            for item, (body, reads) in zip(items, self.map(self.make_body, items)):
+                e, ctx_id = item
+                htmlProperty = HTML_FOR_CONTEXT[ctx_id]
+                if reads is not None:
+                    self.deps[item][0].update(reads)
+
+                # Add the inner (markdown-derived) html to the graph for templates to pick up
+                if self.bodies.get(item) != body:
+                    if item in self.bodies:
+                        tg.apply_delta(removed=[(e.id, htmlProperty, rdflib.Literal(self.bodies[item]))])
+                        bodies_changed.add(e.safe)
+                    logging.debug(f"Adding this inner html as {htmlProperty} to {e.id}@@{ctx_id}:\n{body[:100]}...")
+                    tg.add(e.id, htmlProperty, rdflib.Literal(body))
+                    self.bodies[item] = body
+
+            # render the templates, and find out which pages each one includes
+            contents = {}
+            requires = {}
+            for item, (content, scanned, found, error, reads) in zip(items, self.map(self.render_template, items)):
+                if reads is not None:
+                    self.deps[item][0].update(reads)
+                if error is not None:
+                    failed[item] = error
+                    continue
+
+                rr = set()
+                for src_safe, ctx in found:
+                    if src_safe in tg.entities:
+                        rr.add((tg.entities[src_safe], ctx))
+
+                if rr:
+                    requires[item] = rr
+                    contents[item] = (content, scanned)
+                else:
+                    # nothing to wait for, so there's no need to keep it
+                    self.finish(item, content, scanned, pending, failed, pages_changed)
+        finally:
+            if self.recorder is not None:
+                false.graph.set_profiler(self.recorder.inner)
+                self.recorder = None
+
+        logging.info(f"Rendered {len(contents)} of {len(items)} destinations, putting in what they include")
+
+        # pages that failed aren't in requires, so anything that includes them is found to be missing them below
+        order, cycles = order_by_requirements(requires)
+        for cycle in cycles:
+            path = " -> ".join(f"{e.id}@@{ctx}" for e, ctx in cycle)
+            for item in cycle[:-1]:
+                failed[item] = (PublishError(f"includes itself: {path}"), "")
+
+        for item in order:
+            if item in failed:
                 continue
 
-            upgrade = lambda m: resolve_content_reference(m, tg, cfg.id_base, stage, e, True)
-            inline = lambda m: resolve_content_reference(m, tg, cfg.id_base, stage, e, False)
-
-            try: # don't ask
-                content = re.sub("<p>\s*<em>\s*<false-content([^>]*src=[^>]+)>\s*</false-content>\s*</em>\s*</p>", upgrade, content)
-                content = re.sub("<p>\s*<em>\s*<false-content([^>]*src=[^>]+)>\s*</em>\s*</p>", upgrade, content)
-                content = re.sub("<p>\s*<false-content([^>]*src=[^>]+)>\s*</false-content>\s*</p>", inline, content)
-                content = re.sub("<p>\s*<false-content([^>]*src=[^>]+)>\s*</p>", inline, content)
-                content = re.sub("<em>\s*<false-content([^>]*src=[^>]+)>\s*</false-content>\s*</em>", upgrade, content)
-                content = re.sub("<em>\s*<false-content([^>]*src=[^>]+)>\s*</em>", upgrade, content)
-                content = re.sub("<false-content([^>]*src=[^>]+)>\s*</false-content>", inline, content)
-                content = re.sub("<false-content([^>]*src=[^>]+)>", inline, content)
-                content = re.sub("<false-rescued([^>]*src=[^>]+)>", inline, content)
-            except PublishNotReadyError as err:
-                logging.debug("{e}@@{ctx} deferred: {err}".format(e=e.id, ctx=ctx_id, err=err))
-                next_write[(e, ctx_id)] = (err, traceback.format_exc())
+            missing = [r for r in requires[item] if r in failed]
+            if missing:
+                failed[item] = (PublishNotReadyError("requires {src}@@{ctx}, which couldn't be rendered".format(src=missing[0][0].id, ctx=missing[0][1])), "")
                 continue
 
-            os.makedirs(os.path.dirname(dest), exist_ok=True)
-            logging.debug("{e}@@{ctx}: writing {dest}".format(e=e.id, ctx=ctx_id, dest=dest))
-            with open(dest,'w') as f:
-                f.write(content)
+            self.finish(item, *contents.pop(item), pending, failed, pages_changed)
 
-            progress = True
+        # what's left needs one of the cycles
+        for item in contents:
+            if item not in failed:
+                failed[item] = (PublishNotReadyError("requires a page that includes itself"), "")
 
-        to_write = next_write
+        self.unfinished = set(failed)
+        if failed:
+            err_list = []
+            for item,error in failed.items():
+                err_list.append("{e}@@{ctx}: {err}".format(e=item[0].id, ctx=item[1], err=f"{error[0]}\n{error[1]}"))
+            raise PublishError("{msg}\n     {detail}\n\n".format(msg=PUB_FAIL_MSG, detail='\n\n\n'.join(err_list)))
+        else:
+            logging.info("All written successfully.")
 
-    if to_write:
-        err_list = []
-        for item,error in to_write.items():
-            err_list.append("{e}@@{ctx}: {err}".format(e=item[0].id, ctx=item[1], err=f"{error[0]}\n{error[1]}"))
-        raise PublishError("{msg}\n     {detail}\n\n".format(msg=PUB_FAIL_MSG, detail='\n\n\n'.join(err_list)))
-    else:
-        logging.info("All written successfully.")
+        return bodies_changed, pages_changed
+
+    def make_body(self, item):
+        '''Return the inner HTML of item, and if dependencies are being recorded, the safe names of the entities it looked at.'''
+        e, ctx_id = item
+        reads = None
+        if self.recorder is not None:
+            reads = self.recorder.reads = self.deps[item][0]
+
+        body = get_html_body(self.tg, e, self.tg.entities[self.tg.safePath(ctx_id)], self.markdown_processor, self.cache_dir)
+        return body, reads
+
+    def render_template(self, item):
+        '''Render the template of item. Returns the content, where it includes other pages (from scan_content_references),
+        the (safe name, context) of each of them, the (error, traceback) if it couldn't be rendered, and if dependencies are being recorded, the safe names of the entities it looked at.'''
+        e, ctx_id = item
+        tpl, dest = self.stage[item]
+
+        reads = None
+        if self.recorder is not None:
+            reads = self.recorder.reads = self.deps[item][0]
+        if false.graph.profiler is not None:
+            false.graph.profiler.template = tpl.name
+
+        try:
+            content = e.render(tpl)
+        except (jinja2.exceptions.UndefinedError, RequiredAttributeError) as err:
+            logging.debug(f"{e.id}@@{ctx_id} couldn't be rendered with {tpl}: {err}\nEntity is: {e.debug()}")
+            return None, None, None, (err, traceback.format_exc()), reads
+
+        scanned = scan_content_references(content)
+        return content, scanned, find_content_references(scanned, self.tg, self.cfg.id_base), None, reads
+
+    def map(self, fn, items):
+        '''Return [fn(item) for item in items]. If there are enough items, they are shared between up to self.jobs processes,
+        forked from this one so that they see the graph as it is now without it being copied.
+        Whatever fn changes there is lost, so it has to return everything that is needed, as something that can be pickled.'''
+        global _forked
+
+        processes = min(self.jobs, len(items) // MIN_ITEMS_PER_PROCESS)
+        profiler = self.recorder.inner if self.recorder is not None else false.graph.profiler
+        if processes < 2 or profiler is not None or "fork" not in multiprocessing.get_all_start_methods():
+            # not worth forking for, or lookups counted in other processes would be lost
+            return [fn(item) for item in items]
+
+        logging.info(f"Sharing {len(items)} pages between {processes} processes")
+        _forked = (fn, items)
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("fork")) as pool:
+                return list(pool.map(_call_forked, range(len(items)), chunksize=max(1, len(items) // (processes*4))))
+        finally:
+            _forked = None
+
+    def finish(self, item, content, scanned, pending, failed, pages_changed):
+        '''Put the pages that the rendered content of item includes into it, and write it.
+        scanned is where it includes them, as found by scan_content_references.'''
+        e, ctx_id = item
+        tpl, dest = self.stage[item]
+        includes = self.deps[item][1] if self.deps is not None else None
+        resolve = lambda tag_attrs, upgrade_to_teaser: resolve_content_reference(tag_attrs, self.tg, self.cfg.id_base, self.stage, e, upgrade_to_teaser, pending, includes, self.fragments)
+
+        try:
+            content = substitute_content_references(content, resolve, scanned)
+        except PublishNotReadyError as err:
+            logging.debug("{e}@@{ctx} not ready: {err}".format(e=e.id, ctx=ctx_id, err=err))
+            failed[item] = (err, traceback.format_exc())
+            return
+
+        if self.write_page(dest, content):
+            pages_changed.add(item)
+
+        # pages are big and hardly ever included, so they are only kept once something reads them back
+        if ctx_id == F.page:
+            self.fragments.discard(item)
+        else:
+            self.fragments.put(item, content)
 
-    open(os.path.join(cfg.page_output_dir,"index.html"),"wb").write(('''
+        if pending:
+            pending.discard(item)
+
+    def write_page(self, dest, content):
+        '''Write content to dest, unless it is already there. Returns whether it was written.
+        What is there is known from the hash recorded when it was written, so dest is only read back
+        if nothing is recorded for it, or it has changed since.'''
+        blob = content.encode('utf-8')
+        h = content_hash(blob)
+        try:
+            if self.pages.file_hash(dest) == h:
+                logging.debug(f"{dest} is unchanged")
+                return False
+        except FileNotFoundError:
+            pass
+
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        logging.debug(f"writing {dest}")
+        with open(dest,'wb') as f:
+            f.write(blob)
+        self.pages.wrote(dest, h)
+        return True
+
+    def update(self, changed=(), templates=()):
+        '''Render again whatever might have changed since the last publish or update. Only possible with watch set.
+        changed is the safe names of the entities that have changed in the graph, as returned by TemplatableGraph.apply_delta,
+        and templates is the names of the templates that have changed.
+        Returns the number of pages rendered.'''
+        if self.deps is None:
+            raise ValueError("Publisher wasn't created with watch set, can't update")
+
+        tg = self.tg
+        changed = set(changed)
+        old_stage = dict(self.stage)
+
+        # a template that appeared or went away can change which one every entity uses
+        if templates:
+            self.templates.clear()
+            restage = list(tg.entities.items())
+        else:
+            restage = [(s, tg.entities[s]) for s in changed if s in tg.entities]
+        for e_safe, e in restage:
+            self.unstage_entity(e)
+        for e_safe, e in restage:
+            self.stage_entity(e_safe, e)
+
+        if not self.home_page:
+            raise PublishError("Home page {home} is not staged, can't continue".format(home=self.cfg.home_site))
+
+        # pages that have gone, or are now somewhere else
+        dests = set(dest for tpl, dest in self.stage.values())
+        for item, (tpl, dest) in old_stage.items():
+            if item not in self.stage:
+                self.deps.pop(item, None)
+                self.fragments.discard(item)
+                if item in self.bodies:
+                    tg.apply_delta(removed=[(item[0].id, HTML_FOR_CONTEXT[item[1]], rdflib.Literal(self.bodies.pop(item)))])
+            if dest not in dests and os.path.exists(dest):
+                logging.info(f"removing {dest}")
+                os.remove(dest)
+
+        # a template that isn't used directly by any page might be extended or included by any of them
+        used = set(tpl.name for tpl, dest in self.stage.values())
+        if set(templates) - used:
+            dirty = set(self.stage)
+        else:
+            dirty = set(item for item, (tpl, dest) in self.stage.items() if tpl.name in templates or old_stage.get(item) != (tpl, dest))
+        dirty.update(item for item in self.unfinished if item in self.stage)
+        dirty.update(item for item in self.stage if item[0].safe in changed)
+
+        pages = set((e.safe, ctx) for e, ctx in set(old_stage) ^ set(self.stage))
+
+        rendered = 0
+        while True:
+            # then whatever looked at what changed, or included it
+            for item, (reads, includes) in self.deps.items():
+                if not reads.isdisjoint(changed) or not includes.isdisjoint(pages):
+                    dirty.add(item)
+            dirty.intersection_update(self.stage)
+            if not dirty:
+                break
+
+            logging.info(f"Rendering {len(dirty)} pages again")
+            rendered += len(dirty)
+            changed, pages_changed = self.render(dirty)
+            pages = set((e.safe, ctx) for e, ctx in pages_changed)
+            dirty = set()
+
+        self.pages.save()
+        self.write_index()
+        return rendered
+
+    def write_index(self):
+        if self.home_page == self.index_page:
+            return
+
+        open(os.path.join(self.cfg.page_output_dir,"index.html"),"wb").write(('''
 <!DOCTYPE html>
 <html>
   <head>
     <title>FALSE</title>
-    <meta http-equiv="refresh" content="1; url='''+home_page+'''">
+    <meta http-equiv="refresh" content="1; url='''+self.home_page+'''">
     <style type="text/css">
 html, body { height: 100%; }
 body { display: flex;
@@ -379,10 +777,10 @@ body { display: flex;
   </head>
   <body>
 <div>
-<h1><a href="'''+home_page+'''">Continue to the site</a></h1>
+<h1><a href="'''+self.home_page+'''">Continue to the site</a></h1>
 <h2>Powered by FALSE</h2>
 </div>
   </body>
 </html>
 ''').encode("utf-8"))
-    return home_page
+        self.index_page = self.home_page
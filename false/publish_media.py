@@ -4,10 +4,22 @@ import logging, os, rdflib, re, subprocess, posixpath
 
 F = rdflib.Namespace("http://id.colourcountry.net/false/")
 
-def publish_media(g, output_dir):
+def copy_media(media, output_dir):
+    '''Copy each (IPFS path, local path) in media into the publish area, unless it is already there.'''
     base = os.path.join(output_dir,"ipfs")
     os.makedirs(base,exist_ok=True)
 
+    for s, local_src in media:
+        local_dest = os.path.dirname(os.path.join(output_dir, "ipfs", *posixpath.split(s)))
+        if os.path.exists(local_dest):
+            continue # IPFS paths are content addressed, so what is there already is the same
+        subprocess.run(["cp","-r",local_src,local_dest])
+
+def publish_media(g, output_dir):
+    '''Copy the media in g into the publish area and remove their local paths from g.
+    Returns the (IPFS path, local path) of each, so that copy_media can repeat this later without g.'''
+    media = []
+
     spo = g.triples((None, F.localPath, None))
     for s, p, o in spo:
         local_src = o
@@ -19,8 +31,9 @@ def publish_media(g, output_dir):
         else:
             raise PublishError(f"Unrecognized IPFS (N)URI: {s}")
 
-        local_dest = os.path.dirname(os.path.join(output_dir, "ipfs", *posixpath.split(s)))
-        subprocess.run(["cp","-r",local_src,local_dest])
+        media.append((str(s), str(local_src)))
+
+    copy_media(media, output_dir)
 
     g.remove((None, F.localPath, None))
-    return g
+    return media
@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+
+import re
+
+# Where a page includes another, in the order they are looked for, and whether a link there is upgraded to a teaser.
+# "don't ask"
+CONTENT_REFERENCES = [(re.compile(pattern), upgrade) for pattern, upgrade in [
+    ("<p>\s*<em>\s*<false-content([^>]*src=[^>]+)>\s*</false-content>\s*</em>\s*</p>", True),
+    ("<p>\s*<em>\s*<false-content([^>]*src=[^>]+)>\s*</em>\s*</p>", True),
+    ("<p>\s*<false-content([^>]*src=[^>]+)>\s*</false-content>\s*</p>", False),
+    ("<p>\s*<false-content([^>]*src=[^>]+)>\s*</p>", False),
+    ("<em>\s*<false-content([^>]*src=[^>]+)>\s*</false-content>\s*</em>", True),
+    ("<em>\s*<false-content([^>]*src=[^>]+)>\s*</em>", True),
+    ("<false-content([^>]*src=[^>]+)>\s*</false-content>", False),
+    ("<false-content([^>]*src=[^>]+)>", False),
+    ("<false-rescued([^>]*src=[^>]+)>", False),
+]]
+
+# All of the patterns above at once, sharing their common beginnings. At each place, the first alternative that matches
+# is the pattern that would have replaced it, and the last group it matched, lastindex, says which one that was.
+TAG = "<false-content([^>]*src=[^>]+)>"
+CONTENT_SCANNER = re.compile("<(?:"
+    "p>\s*(?:<em>\s*"+TAG+"(?:(\s*</false-content>)\s*</em>\s*</p>|\s*</em>\s*</p>)" # groups 1, 2
+        "|"+TAG+"(?:(\s*</false-content>)\s*</p>|\s*</p>))" # 3, 4
+    "|em>\s*"+TAG+"(?:(\s*</false-content>)\s*</em>|\s*</em>)" # 5, 6
+    "|"+TAG[1:]+"(\s*</false-content>)?" # 7, 8
+    "|false-rescued([^>]*src=[^>]+)>)") # 9
+
+# (index in CONTENT_REFERENCES, group of the tag's attributes, upgrade) by the lastindex of a CONTENT_SCANNER match:
+# when a group after the attributes is matched, it's the first of the two patterns, otherwise the second
+SCANNED = [None] + [(k, group, CONTENT_REFERENCES[k][1]) for k, group in
+    [(1, 1), (0, 1), (3, 3), (2, 3), (5, 5), (4, 5), (7, 7), (6, 7), (8, 9)]]
+
+def substitute_in_turn(content, resolve):
+    '''Replace each place where content includes another page with resolve(attributes, upgrade_to_teaser),
+    where attributes are those of its false-content tag, one pattern at a time, as publishing always has.'''
+    for pattern, upgrade in CONTENT_REFERENCES:
+        content = pattern.sub(lambda m: resolve(m.group(1), upgrade), content)
+    return content
+
+# What a replacement can start with or end with that could change which pattern matches next to it
+CLOSING = re.compile("\s*(?:</p>|</em>|</false-content>|\Z)")
+OPENING = ("<p>", "<em>")
+
+def moves_wrappers(r):
+    '''True if the replacement r could change which pattern matches next to it: it is blank, starts with a closing wrapper
+    or ends with an opening one, or includes another page itself.'''
+    return "<false-" in r or CLOSING.match(r) is not None or (r.rstrip() if r[-1:].isspace() else r).endswith(OPENING)
+
+def scan_content_references(content):
+    '''Return (start, end, pattern, attributes) for each place where content includes another page, in the order
+    they appear, where pattern is the index in CONTENT_REFERENCES of the one that would replace it.
+    This is all plain values, so it can be kept with the content, or sent back from another process.'''
+    if "<false-" not in content:
+        return []
+    scanned = []
+    for m in CONTENT_SCANNER.finditer(content):
+        k, group, upgrade = SCANNED[m.lastindex]
+        scanned.append((m.start(), m.end(), k, m.group(group)))
+    return scanned
+
+def substitute_content_references(content, resolve, scanned=None):
+    '''Replace each place where content includes another page with resolve(attributes, upgrade_to_teaser),
+    with the same result as substitute_in_turn, but finding every tag and what it is wrapped in with one pass.
+    scanned, if given, is what scan_content_references returned for content, so that it isn't scanned again.
+
+    resolve is called in the same order, for the same patterns, but only once for each tag and pattern.
+    Where a replacement could let a later pattern match something new, such as an empty one that leaves a <p>
+    next to another tag, the rest is done with substitute_in_turn instead, reusing what resolve returned.'''
+    if scanned is None:
+        scanned = scan_content_references(content)
+    if not scanned:
+        return content
+
+    by_pattern = [[] for p in CONTENT_REFERENCES]
+    for start, end, k, attrs in scanned:
+        by_pattern[k].append(attrs)
+
+    resolved = {False: {}, True: {}} # upgrade: {attributes: replacement}
+    def memo(attrs, upgrade):
+        r = resolved[upgrade].get(attrs)
+        if r is None:
+            r = resolved[upgrade][attrs] = resolve(attrs, upgrade)
+        return r
+
+    for found, (pattern, upgrade) in zip(by_pattern, CONTENT_REFERENCES):
+        done = resolved[upgrade]
+        moved = False
+        for attrs in found:
+            if attrs not in done:
+                r = done[attrs] = resolve(attrs, upgrade)
+                moved = moved or moves_wrappers(r)
+        if moved:
+            # what the later patterns find isn't what was scanned any more
+            return substitute_in_turn(content, memo)
+
+    replacements = [resolved[upgrade] for pattern, upgrade in CONTENT_REFERENCES]
+    out = []
+    last = 0
+    for start, end, k, attrs in scanned:
+        out.append(content[last:start])
+        out.append(replacements[k][attrs])
+        last = end
+    out.append(content[last:])
+    return "".join(out)
@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+
+import logging, os, glob, gc, hashlib, pickle
+
+import false.graph
+
+# Bump this whenever the contents of a snapshot change
+SNAPSHOT_VERSION = 1
+
+SNAPSHOT_PREFIX = "__snapshot-"
+
+def digest(ttl_files, media_files, id_base, options={}):
+    '''Return a digest of everything the published graph is built from.
+    TTL files are hashed by content, media files by size and modification time, as they can be large.
+    The source of FALSE itself is included, so that a changed builder doesn't reuse an old snapshot,
+    and so is options, which should be every option the builder was run with.'''
+    h = hashlib.sha256()
+    h.update(f"{SNAPSHOT_VERSION} {false.graph.PICKLE_FORMAT} {id_base}\n".encode("utf-8"))
+    h.update(f"{sorted(options.items())}\n".encode("utf-8"))
+
+    code = glob.glob(os.path.join(os.path.dirname(__file__), "*.py"))
+    for fn in sorted(code) + sorted(ttl_files):
+        h.update(f"{fn}\n".encode("utf-8"))
+        h.update(open(fn, "rb").read())
+
+    for fn in sorted(media_files):
+        st = os.stat(fn)
+        h.update(f"{fn} {st.st_size} {st.st_mtime_ns}\n".encode("utf-8"))
+
+    return h.hexdigest()
+
+def _path(work_dir, d):
+    return os.path.join(work_dir, SNAPSHOT_PREFIX+d+".pickle")
+
+def load(work_dir, d):
+    '''Return the (media, TemplatableGraph) saved under the digest d, or None if there isn't one.'''
+    fn = _path(work_dir, d)
+    if not os.path.exists(fn):
+        logging.info(f"No snapshot for {d}")
+        return None
+
+    # The graph is millions of small objects, none of them garbage,
+    # and the cycle collector would otherwise scan them over and over as they arrive.
+    gc.disable()
+    try:
+        version, media, tg = pickle.load(open(fn, "rb"))
+    except Exception as e:
+        logging.warning(f"Couldn't load snapshot {fn}: {e}")
+        return None
+    finally:
+        gc.enable()
+
+    if version != SNAPSHOT_VERSION:
+        logging.info(f"Snapshot {fn} is version {version}, expected {SNAPSHOT_VERSION}")
+        return None
+
+    logging.info(f"Loaded snapshot {fn}")
+    return media, tg
+
+def save(work_dir, d, media, tg):
+    '''Save media and tg under the digest d, replacing any older snapshots.
+    tg must not have been published yet, as publishing adds rendered HTML to it.'''
+    fn = _path(work_dir, d)
+    tmp = fn+".tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump((SNAPSHOT_VERSION, media, tg), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, fn)
+
+    for old in glob.glob(os.path.join(work_dir, SNAPSHOT_PREFIX+"*.pickle")):
+        if old != fn:
+            os.remove(old)
+
+    logging.info(f"Saved snapshot {fn}")
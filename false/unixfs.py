@@ -0,0 +1,152 @@
+#!/usr/bin/python3
+
+import os, hashlib, concurrent.futures, subprocess
+
+# Computes the IPFS hashes (CIDv0) that `ipfs add -Qnr` gives, without needing ipfs.
+# Files are laid out as go-ipfs does by default: 256KiB chunks, a balanced DAG of up to 174 links per node,
+# and dag-pb (not raw) leaves, the first of type File and the rest of type Raw, as go-unixfs's balanced builder makes them.
+# Like `ipfs add` without --hidden, files starting with . are left out.
+# Directories are never sharded, which go-ipfs only does for directories with thousands of entries.
+
+CHUNK_SIZE = 262144
+MAX_LINKS = 174
+
+# Files bigger than this are more than one chunk, and their layout hasn't been checked against go-ipfs yet,
+# so directories holding them are left to `ipfs add -Qnr`. None once LARGE_FILE_HASHES has been filled in and checked.
+VERIFIED_FILE_SIZE = CHUNK_SIZE
+
+# UnixFS node types
+RAW = 0
+DIRECTORY = 1
+FILE = 2
+
+BASE58 = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+
+# Hashes that go-ipfs gives, to check against
+KNOWN_HASHES = {
+    b"": "QmbFMke1KXqnYyBBWxB74N4c5SBnJMVAiMNRcGu6x1AwQH",
+    b"hello world\n": "QmT78zSuBmuS4z925WZfrqQ1qHaJ56DQaTfyMUF7F8ff5o",
+}
+EMPTY_DIR_HASH = "QmUNLLsPACCz1vLxQVkXqqLX5R1X345qqfHbsf67hvA3Nn"
+
+# Sizes of files of large_file_bytes to check: about 1MiB (one level of links), and past MAX_LINKS chunks (two levels)
+LARGE_FILE_SIZES = (1048576 + 1, MAX_LINKS * CHUNK_SIZE + 1)
+
+# Hashes that go-ipfs gives for files of large_file_bytes, by size, from `python3 tools/check_unixfs.py` where ipfs is installed
+LARGE_FILE_HASHES = {}
+
+def large_file_bytes(size):
+    '''Return size bytes that don't repeat from one chunk to the next, so that every leaf has its own hash.'''
+    return b"".join(hashlib.sha256(i.to_bytes(8, "big")).digest() for i in range(size // 32 + 1))[:size]
+
+def varint(n):
+    r = bytearray()
+    while n > 0x7f:
+        r.append((n & 0x7f) | 0x80)
+        n >>= 7
+    r.append(n)
+    return bytes(r)
+
+def pb_varint(field, n):
+    return varint(field << 3) + varint(n)
+
+def pb_bytes(field, b):
+    return varint(field << 3 | 2) + varint(len(b)) + b
+
+def unixfs_data(t, data=b"", filesize=None, blocksizes=()):
+    r = pb_varint(1, t)
+    if data:
+        r += pb_bytes(2, data)
+    if filesize is not None:
+        r += pb_varint(3, filesize)
+    for b in blocksizes:
+        r += pb_varint(4, b)
+    return r
+
+def dag_pb(data, links=()):
+    '''Serialize a dag-pb node. links are (multihash, name, cumulative size), and are written before the data, as go-ipfs does.'''
+    r = b"".join(pb_bytes(2, pb_bytes(1, h) + pb_bytes(2, name.encode("utf-8")) + pb_varint(3, tsize)) for h, name, tsize in links)
+    return r + pb_bytes(1, data)
+
+def multihash(block):
+    return b"\x12\x20" + hashlib.sha256(block).digest()
+
+def base58(b):
+    n = int.from_bytes(b, "big")
+    r = ""
+    while n:
+        n, d = divmod(n, 58)
+        r = BASE58[d] + r
+    return BASE58[0] * (len(b) - len(b.lstrip(b"\0"))) + r
+
+def file_dag(f):
+    '''Return (multihash, cumulative size, file size) of the DAG for the contents of the binary file object f.'''
+    nodes = []
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk and nodes:
+            break
+        block = dag_pb(unixfs_data(RAW if nodes else FILE, chunk, len(chunk)))
+        nodes.append((multihash(block), len(block), len(chunk)))
+        if not chunk:
+            break
+
+    # a file of one chunk is just that chunk, otherwise each level links to up to MAX_LINKS nodes of the one below
+    while len(nodes) > 1:
+        parents = []
+        for i in range(0, len(nodes), MAX_LINKS):
+            children = nodes[i:i+MAX_LINKS]
+            filesize = sum(c[2] for c in children)
+            block = dag_pb(unixfs_data(FILE, filesize=filesize, blocksizes=[c[2] for c in children]),
+                           [(h, "", tsize) for h, tsize, size in children])
+            parents.append((multihash(block), len(block) + sum(c[1] for c in children), filesize))
+        nodes = parents
+
+    return nodes[0]
+
+def verified(path):
+    '''True if every file in the directory at path is small enough for its layout to have been checked against go-ipfs.'''
+    if VERIFIED_FILE_SIZE is None:
+        return True
+    for entry in os.scandir(path):
+        if entry.name.startswith("."):
+            continue
+        if entry.is_dir():
+            if not verified(entry.path):
+                return False
+        elif entry.stat().st_size > VERIFIED_FILE_SIZE:
+            return False
+    return True
+
+def dir_dag(path):
+    '''Return (multihash, cumulative size) of the DAG for the directory at path.'''
+    links = []
+    for entry in sorted(os.scandir(path), key=lambda e: e.name):
+        if entry.name.startswith("."):
+            continue
+        if entry.is_dir():
+            h, tsize = dir_dag(entry.path)
+        else:
+            with open(entry.path, "rb") as f:
+                h, tsize, size = file_dag(f)
+        links.append((h, entry.name, tsize))
+
+    block = dag_pb(unixfs_data(DIRECTORY), links)
+    return multihash(block), len(block) + sum(tsize for h, name, tsize in links)
+
+def hash_dir(path):
+    '''Return the IPFS hash of the directory at path, as `ipfs add -Qnr` would.
+    If it holds a file bigger than VERIFIED_FILE_SIZE, `ipfs add -Qnr` is asked instead, so ipfs has to be installed.'''
+    if not verified(path):
+        return subprocess.run(["ipfs","add","-Qnr",path], stdout=subprocess.PIPE, check=True).stdout.strip().decode("us-ascii")
+    return base58(dir_dag(path)[0])
+
+def hash_dirs(paths, jobs=None):
+    '''Return the IPFS hashes of many directories, in the same order, hashing up to jobs of them at once.'''
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(hash_dir, paths))
+
+def hash_bytes(b):
+    '''Return the IPFS hash of a file containing b.'''
+    import io
+    return base58(file_dag(io.BytesIO(b))[0])
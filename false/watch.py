@@ -0,0 +1,53 @@
+#!/usr/bin/python3
+
+import logging, os, time
+
+# How often to look for changes, in seconds
+WATCH_INTERVAL = 0.5
+
+class Watcher:
+    '''Looks for files that have been added, changed or removed under some directories, by polling.
+    Like the builder, it leaves out directories that start with . or _.'''
+
+    def __init__(self, *roots):
+        self.roots = roots
+        self.files = self.scan()
+
+    def scan(self):
+        '''Return {path: (size, mtime)} for every file under the roots.'''
+        r = {}
+        stack = list(self.roots)
+        while stack:
+            path = stack.pop()
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        if entry.is_dir():
+                            if not entry.name.startswith('.') and not entry.name.startswith('_'):
+                                stack.append(entry.path)
+                        else:
+                            st = entry.stat()
+                            r[entry.path] = (st.st_size, st.st_mtime_ns)
+            except OSError as err:
+                logging.debug(f"Can't look in {path}: {err}")
+        return r
+
+    def changes(self):
+        '''Return the paths that have been added, changed or removed since the last call.'''
+        files = self.scan()
+        changed = set(f for f in files if self.files.get(f) != files[f])
+        changed.update(f for f in self.files if f not in files)
+        self.files = files
+        return changed
+
+    def wait(self, interval=WATCH_INTERVAL):
+        '''Wait until something changes, and return the paths that did.
+        Changes are collected until they stop, so that saving several files at once is seen as one change.'''
+        changed = set()
+        while True:
+            c = self.changes()
+            if c:
+                changed.update(c)
+            elif changed:
+                return changed
+            time.sleep(interval)
@@ -11,6 +11,12 @@ export FALSE_WORK_DIR=_build # because this outputs some TTL, it should be hidde
 export FALSE_ID_BASE=http://id.colourcountry.net/2018/
 export FALSE_HOME_SITE=http://id.colourcountry.net/2018/false-test
 export FALSE_LOG_FILE=false.log
+#export FALSE_PROFILE=1 # report template attribute lookups after publishing
+#export FALSE_JOBS=4 # how many media conversions, hashes and page renders to run at once (default: one per CPU)
+#export FALSE_IMAGE_BACKEND=pil # convert images in-process with Pillow, rather than running ImageMagick's convert for each size
+#export FALSE_IPFS_ADD=1 # add media to IPFS with the ipfs command, rather than only working out their hashes
+#export FALSE_NO_SNAPSHOT=1 # always build, rather than reusing the last run's graph when nothing has changed
+#export FALSE_WATCH=1 # after publishing, keep publishing whatever changes in the sources and templates
 
 
 rm -f "$FALSE_LOG_FILE"
@@ -20,6 +26,12 @@ mkdir -p "$FALSE_OUT/ipfs"
 #python3 ./prepare_media.sh "$FALSE_SRC"
 cp -avu static "$FALSE_OUT/static"
 
+if [ -n "$FALSE_WATCH" ]; then
+    # false.py prints the home page once it has published, then carries on watching
+    python3 false.py | { read FALSE_HOME_PAGE; python3 server.py "$FALSE_HOME_PAGE"; }
+    exit
+fi
+
 export FALSE_HOME_PAGE=`time python3 false.py`
 
 python3 server.py "$FALSE_HOME_PAGE"
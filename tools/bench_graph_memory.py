@@ -0,0 +1,55 @@
+#!/usr/bin/python3
+
+# Benchmark: python3 tools/bench_graph_memory.py [ENTITIES] builds a graph of that many entities, 6 triples each,
+# on top of FALSE's own ontology, and reports the memory it holds on to
+
+import os, sys, tracemalloc, gc, random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rdflib
+from rdflib.namespace import RDF, SKOS
+
+import false.graph
+from false.graph import TemplatableGraph, TemplatableEntity
+
+n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+F = rdflib.Namespace("http://id.colourcountry.net/false/")
+X = rdflib.Namespace("http://example.org/")
+g = rdflib.Graph()
+for fn in ("false.ttl", "false-xl.ttl"):
+    g.parse(os.path.join(os.path.dirname(false.graph.__file__), fn), format="ttl")
+g.bind("x", X)
+
+random.seed(1)
+types = [F.WebPage, F.Media, F.Content, F.Work, SKOS.Concept]
+for i in range(n):
+    s = X[f"item{i}"]
+    g.add((s, RDF.type, random.choice(types)))
+    g.add((s, SKOS.prefLabel, rdflib.Literal(f"Item {i}", lang="en")))
+    g.add((s, F.published, rdflib.Literal(f"2018-{i%12+1:02d}-{i%28+1:02d}")))
+    g.add((s, F.mentions, X[f"item{random.randrange(n)}"]))
+    g.add((s, F.incorporates, X[f"item{random.randrange(n)}"]))
+    g.add((s, F.hasAvailability, F.public))
+
+gc.collect()
+tracemalloc.start()
+tg = TemplatableGraph(g)
+gc.collect()
+retained, peak = tracemalloc.get_traced_memory()
+tracemalloc.stop()
+print(f"{len(g)} triples, {len(tg.entities)} entities: retained {retained/1e6:.1f}MB, peak {peak/1e6:.1f}MB, "
+      f"{retained/len(tg.entities):.0f} bytes per entity")
+
+# the same attributes as one of the entities, held in a __dict__ as they would be without __slots__
+e = tg.entities[tg.safePath(X.item0)]
+class Unslotted:
+    pass
+u = Unslotted()
+for a in TemplatableEntity.__slots__:
+    try:
+        setattr(u, a, object.__getattribute__(e, a))
+    except AttributeError:
+        pass # an unset slot
+print(f"an entity's own size: {sys.getsizeof(e)} bytes with __slots__, "
+      f"{sys.getsizeof(u) + sys.getsizeof(u.__dict__)} with a __dict__")
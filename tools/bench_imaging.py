@@ -0,0 +1,32 @@
+#!/usr/bin/python3
+
+# Benchmark: python3 tools/bench_imaging.py IMAGE... converts each image for every context both ways, and compares them
+
+import os, sys, time, tempfile, subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+
+import false.build as fb
+from false.imaging import convert_image
+
+contexts = list(fb.IMAGE_GEOMETRY)
+with tempfile.TemporaryDirectory() as tmp:
+    for fn in sys.argv[1:]:
+        ext = os.path.splitext(fn)[1]
+        dests = {backend: [os.path.join(tmp, f"{backend}-{i}{ext}") for i in range(len(contexts))] for backend in fb.IMAGE_BACKENDS}
+
+        t = time.time()
+        for ctx, dest in zip(contexts, dests['convert']):
+            subprocess.run(fb.convert_image[ctx](fn, dest), check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        t_convert = time.time()-t
+
+        t = time.time()
+        convert_image(fn, [(fb.IMAGE_GEOMETRY[ctx], dest) for ctx, dest in zip(contexts, dests['pil'])])
+        t_pil = time.time()-t
+
+        print(f"{fn}: convert {t_convert:.2f}s, pil {t_pil:.2f}s ({t_convert/t_pil:.1f}x)")
+        for ctx, a, b in zip(contexts, dests['convert'], dests['pil']):
+            with Image.open(a) as ia, Image.open(b) as ib:
+                print(f"    {ctx.split('/')[-1]}: convert {ia.size}, pil {ib.size}")
@@ -0,0 +1,29 @@
+#!/usr/bin/python3
+
+# Benchmark: python3 tools/bench_references.py compares the two on listing pages of about 1MB, from many teasers to few
+
+import os, sys, timeit, random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from false.references import scan_content_references, substitute_in_turn, substitute_content_references
+
+random.seed(1)
+wrappings = ["<p><em>{}</false-content></em></p>", "<p>{}</p>", "<li>{}</false-content></li>", "<em>{}</em>",
+             "<div>\n  {}\n</div>", "<p>see {} and more</p>"]
+teaser = lambda attrs, upgrade: '<div class="teaser"><a href="{}">{}</a></div>'.format(attrs[-10:], upgrade)
+
+for tags in (5000, 1000, 100, 10):
+    text = "<p>Some text about an item, <strong>with</strong> markup.</p>\n" * (15000//tags)
+    page = "<html><body><h1>Listing</h1>\n" + "\n".join(
+        "<section>" + text + random.choice(wrappings).format(
+            f'<false-content alt="item" context="http://id.colourcountry.net/false/teaser" src="http://example.org/item{i}">')
+        + "</section>" for i in range(tags)) + "\n</body></html>"
+
+    # best of many single runs, since one busy moment can swamp a few milliseconds
+    scanned = scan_content_references(page)
+    times = [min(timeit.repeat(f, number=1, repeat=50)) for f in (lambda: substitute_in_turn(page, teaser),
+             lambda: substitute_content_references(page, teaser), lambda: substitute_content_references(page, teaser, scanned))]
+    print(f"{tags} tags in {len(page)} characters: in turn {times[0]*1000:.1f}ms, one pass {times[1]*1000:.1f}ms ({times[0]/times[1]:.1f}x), "
+          f"already scanned {times[2]*1000:.1f}ms ({times[0]/times[2]:.1f}x)")
+    assert substitute_in_turn(page, teaser) == substitute_content_references(page, teaser) == substitute_content_references(page, teaser, scanned)
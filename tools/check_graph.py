@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+
+# Check: python3 tools/check_graph.py [SEED] applies random deltas to a small graph, and compares the result with
+# building the graph again from scratch after each one. It also checks the types of things in a class cycle.
+
+import os, sys, random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rdflib
+from rdflib.namespace import RDF, RDFS, OWL
+
+from false.graph import TemplatableGraph
+
+X = rdflib.Namespace("http://example.org/")
+
+def check_deltas(seed):
+    random.seed(seed)
+    g = rdflib.Graph()
+    g.bind("x", X)
+
+    # a plain predicate, a symmetric one and a pair of inverses, each with a super-property that isn't
+    types = [X[f"Type{i}"] for i in range(5)]
+    predicates = [X.plain, X.symmetric, X.forward, X.backward, X.broader, X.narrower]
+    items = [X[f"item{i}"] for i in range(30)]
+    hierarchy = [(X.plain, RDFS.subPropertyOf, X.plainSuper),
+                 (X.symmetric, RDFS.subPropertyOf, X.symmetricSuper),
+                 (X.forward, RDFS.subPropertyOf, X.forwardSuper),
+                 (X.backward, RDFS.subPropertyOf, X.backwardSuper),
+                 (X.broader, RDFS.subPropertyOf, X.plain)]
+    # apply_delta can't change inverses, so these stay
+    declarations = [(X.symmetric, RDF.type, OWL.SymmetricProperty), (X.forward, OWL.inverseOf, X.backward),
+                    (X.broader, OWL.inverseOf, X.narrower)]
+    for t in declarations + hierarchy:
+        g.add(t)
+
+    def random_triple():
+        if random.random() < 0.1:
+            return random.choice(hierarchy + [(random.choice(types), RDFS.subClassOf, random.choice(types)),
+                                              (random.choice(predicates), RDFS.subPropertyOf, random.choice(predicates))])
+        if random.random() < 0.2:
+            return (random.choice(items), RDF.type, random.choice(types))
+        if random.random() < 0.1:
+            return (random.choice(items), X.plain, rdflib.Literal(random.randrange(3)))
+        return (random.choice(items), random.choice(predicates), random.choice(items))
+
+    def entries(tg):
+        return {(e.safe, ps, o if isinstance(o, rdflib.Literal) else o.safe)
+                for e in tg.entities.values() for ps, oo in e.po.items() if ps != 'this' for o in oo}
+
+    for i in range(200):
+        g.add(random_triple())
+
+    tg = TemplatableGraph(g)
+    for i in range(300):
+        triples = [t for t in g if t not in declarations]
+        removed = random.sample(triples, random.randrange(4)) + [random_triple() for j in range(random.randrange(2))]
+        added = [random_triple() for j in range(random.randrange(4))]
+        for t in removed:
+            g.remove(t)
+        for t in added:
+            g.add(t)
+
+        tg.apply_delta(added, removed)
+        expected = entries(TemplatableGraph(g))
+        actual = entries(tg)
+        assert actual == expected, f"seed {seed}, delta {i}: {sorted(actual-expected)[:5]} extra, {sorted(expected-actual)[:5]} missing"
+
+def check_class_cycle():
+    g = rdflib.Graph()
+    g.add((X.A, RDFS.subClassOf, X.B))
+    g.add((X.B, RDFS.subClassOf, X.A))
+    g.add((X.B, RDFS.subClassOf, X.C))
+    g.add((X.x, RDF.type, X.A))
+    g.add((X.y, RDF.type, X.C))
+
+    tg = TemplatableGraph(g)
+    x = tg.entities[tg.safePath(X.x)]
+    assert {t.id for t in x.type()} == {X.A, X.B}, x.type()
+    assert x.type_id() in (X.A, X.B), x.type_id()
+    y = tg.entities[tg.safePath(X.y)]
+    assert y.type_id() == X.C, y.type_id()
+
+if __name__=="__main__":
+    check_class_cycle()
+    for seed in ([int(sys.argv[1])] if len(sys.argv) > 1 else range(1, 4)):
+        check_deltas(seed)
+    print("ok")
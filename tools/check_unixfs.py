@@ -0,0 +1,28 @@
+#!/usr/bin/python3
+
+# Check: python3 tools/check_unixfs.py compares with hashes from go-ipfs, and with ipfs itself if it is installed
+
+import os, sys, tempfile, shutil, subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from false.unixfs import KNOWN_HASHES, EMPTY_DIR_HASH, LARGE_FILE_SIZES, LARGE_FILE_HASHES, large_file_bytes, hash_bytes, hash_dir
+
+for b, h in KNOWN_HASHES.items():
+    assert hash_bytes(b) == h, (b, hash_bytes(b), h)
+assert hash_dir(tempfile.mkdtemp()) == EMPTY_DIR_HASH
+
+for size in LARGE_FILE_SIZES:
+    h = hash_bytes(large_file_bytes(size))
+    if size in LARGE_FILE_HASHES:
+        assert h == LARGE_FILE_HASHES[size], (size, h, LARGE_FILE_HASHES[size])
+    if shutil.which("ipfs"):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(large_file_bytes(size))
+            f.flush()
+            expected = subprocess.run(["ipfs","add","-Qn",f.name], stdout=subprocess.PIPE, check=True).stdout.strip().decode("us-ascii")
+        print(f"{size} bytes: ipfs gives {expected}, computed {h}")
+        assert h == expected
+    elif size not in LARGE_FILE_HASHES:
+        print(f"{size} bytes: not checked, there's no go-ipfs hash for it and ipfs isn't installed")
+print("ok")